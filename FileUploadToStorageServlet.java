@@ -3,7 +3,9 @@ package com.tgrape.shotly.servlet;
 import java.io.BufferedReader;
 import java.io.File;
 import java.io.IOException;
+import java.io.InputStream;
 import java.io.InputStreamReader;
+import java.io.OutputStream;
 import java.text.SimpleDateFormat;
 import java.util.Date;
 import java.util.Enumeration;
@@ -139,8 +141,6 @@ public class FileUploadToStorageServlet extends HttpServlet {
 					fileName = sf.format(new Date()) + "_"+ fileName ;
 					
 					
-					File uploadFile = new File(tempDir, fileName);
-					item.write(uploadFile);
 					
 					
 					
@@ -149,7 +149,8 @@ public class FileUploadToStorageServlet extends HttpServlet {
 					//TODO Upload To Storage (2013-11-04, 유근명)					
 					
 					System.out.print("bash : ");
-					String cmd = tempDir+"swift.sh upload upload "+fileName;
+					// 파일을 디스크에 쓰지 않고 표준입력으로 바로 전송
+					String cmd = tempDir+"swift.sh upload --stdin upload "+fileName;
 					System.out.println(cmd);
 					
 //					String logFile = tempDir+"upload.list";
@@ -159,6 +160,18 @@ public class FileUploadToStorageServlet extends HttpServlet {
 						String[] command = {"/bin/sh", "-c", cmd};
 
 						Process p = Runtime.getRuntime().exec(command);
+						InputStream in = item.getInputStream();
+						OutputStream out = p.getOutputStream();
+						try {
+							byte[] buf = new byte[65536];
+							int len;
+							while( (len = in.read(buf)) != -1 ) {
+								out.write(buf, 0, len);
+							}
+						} finally {
+							in.close();
+							out.close();
+						}
 						p.waitFor();
 			            System.out.println("return code: "+ p.exitValue());
 					} catch (IOException e) {
@@ -176,7 +189,6 @@ public class FileUploadToStorageServlet extends HttpServlet {
 					
 					
 					item.delete(); // 임시파일 삭제
-					uploadFile.delete();	//저장파일 삭제
 					
 					
 					// 2013.04.08 - 서버 도메인 수정
@@ -14,15 +14,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque, OrderedDict
 from errno import EEXIST, ENOENT
-from hashlib import md5
+from hashlib import md5, sha1
+from hmac import new as hmac_new
+from heapq import heappop, heappush, merge as heapq_merge
+from multiprocessing import cpu_count, Pool
 from optparse import OptionParser
-from os import environ, listdir, makedirs, utime
-from os.path import basename, dirname, getmtime, getsize, isdir, join
+from os import close, environ, fdopen, fstat, fsync, getpid, link, listdir, \
+    makedirs, O_CREAT, O_EXCL, O_WRONLY, open as os_open, rename, \
+    stat as os_stat, unlink, utime
+from os.path import basename, dirname, exists, getmtime, getsize, isdir, \
+    join, splitext
 from Queue import Empty, Queue
-from sys import argv, exit, stderr, stdout
-from threading import enumerate as threading_enumerate, Thread
-from time import sleep
+from random import sample
+from shlex import split as shlex_split
+from stat import S_ISDIR
+from subprocess import Popen
+from sys import argv, exc_info, executable, exit, stderr, stdin, stdout
+from threading import Condition, enumerate as threading_enumerate, Lock, \
+    Thread
+from time import sleep, time
+from traceback import format_exc
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -30,8 +48,12 @@ from time import sleep
 
 import socket
 from cStringIO import StringIO
-from httplib import HTTPException, HTTPSConnection
+from httplib import CONTINUE, HTTPException, HTTPSConnection
 from re import compile, DOTALL
+from select import select
+from shutil import copyfile
+from tarfile import BLOCKSIZE, PAX_FORMAT, TarInfo
+from tempfile import mkstemp
 from tokenize import generate_tokens, STRING, NAME, OP
 from urllib import quote as _quote, unquote
 from urlparse import urlparse, urlunparse
@@ -47,6 +69,13 @@ try:
 except Exception:
     from httplib import HTTPConnection
 
+try:
+    # 2.7.9 and later verify certificates with a context loaded per
+    # connection unless one is passed in
+    from ssl import _create_default_https_context
+except ImportError:
+    _create_default_https_context = None
+
 
 def quote(value, safe='/'):
     """
@@ -60,11 +89,11 @@ def quote(value, safe='/'):
 # look for a real json parser first
 try:
     # simplejson is popular and pretty good
-    from simplejson import loads as json_loads
+    from simplejson import dumps as json_dumps, loads as json_loads
 except ImportError:
     try:
         # 2.6 will have a json module in the stdlib
-        from json import loads as json_loads
+        from json import dumps as json_dumps, loads as json_loads
     except ImportError:
         # fall back on local parser otherwise
         comments = compile(r'/\*.*\*/|//[^\r\n]*', DOTALL)
@@ -94,6 +123,28 @@ except ImportError:
             except Exception:
                 raise AttributeError()
 
+        def json_dumps(obj):
+            '''
+            Minimal json encoder for the dicts, lists, strings and numbers
+            st prints.
+            '''
+            if isinstance(obj, dict):
+                return '{%s}' % ', '.join('%s: %s' % (json_dumps(key),
+                    json_dumps(value)) for key, value in obj.iteritems())
+            if isinstance(obj, (list, tuple)):
+                return '[%s]' % ', '.join(json_dumps(item) for item in obj)
+            if obj is None:
+                return 'null'
+            if obj is True or obj is False:
+                return obj and 'true' or 'false'
+            if isinstance(obj, (int, long, float)):
+                return repr(obj)
+            if isinstance(obj, str):
+                obj = obj.decode('utf8', 'replace')
+            return '"%s"' % ''.join((' ' <= char < '\x7f' and
+                char not in '"\\') and char or '\\u%04x' % ord(char)
+                for char in obj)
+
 
 class ClientException(Exception):
 
@@ -142,10 +193,51 @@ class ClientException(Exception):
         return b and '%s: %s' % (a, b) or a
 
 
+# Seconds a host name lookup is reused for new connections.
+DNS_TTL = 60
+# (host, port) -> (time looked up, getaddrinfo results)
+_dns_cache = {}
+_ssl_context = []
+
+
+def _cached_create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                              source_address=None):
+    """
+    Like socket.create_connection, but reuses host name lookups for DNS_TTL
+    seconds. A lookup that no address could be connected to is forgotten.
+    """
+    host, port = address
+    cached = _dns_cache.get(address)
+    if cached and time() - cached[0] < DNS_TTL:
+        addrinfo = cached[1]
+    else:
+        addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        _dns_cache[address] = (time(), addrinfo)
+    err = socket.error('getaddrinfo returns an empty list')
+    for family, socktype, proto, _junk, sockaddr in addrinfo:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error, err:
+            if sock is not None:
+                sock.close()
+    _dns_cache.pop(address, None)
+    raise err
+
+
 def http_connection(url):
     """
     Make an HTTPConnection or HTTPSConnection
 
+    New connections reuse recent host name lookups, and HTTPS connections
+    share one SSL context instead of loading the CA certificates each time.
+
     :param url: url to connect to
     :returns: tuple of (parsed url, connection object)
     :raises ClientException: Unable to handle protocol scheme
@@ -154,10 +246,16 @@ def http_connection(url):
     if parsed.scheme == 'http':
         conn = HTTPConnection(parsed.netloc)
     elif parsed.scheme == 'https':
-        conn = HTTPSConnection(parsed.netloc)
+        if _create_default_https_context:
+            if not _ssl_context:
+                _ssl_context.append(_create_default_https_context())
+            conn = HTTPSConnection(parsed.netloc, context=_ssl_context[0])
+        else:
+            conn = HTTPSConnection(parsed.netloc)
     else:
         raise ClientException('Cannot handle protocol scheme %s for url %s' %
                               (parsed.scheme, repr(url)))
+    conn._create_connection = _cached_create_connection
     return parsed, conn
 
 
@@ -178,6 +276,14 @@ def get_auth(url, user, key, snet=False):
     :returns: tuple of (storage URL, auth token)
     :raises ClientException: HTTP GET request to auth URL failed
     """
+    return _get_auth(url, user, key, snet=snet)[:2]
+
+
+def _get_auth(url, user, key, snet=False):
+    """
+    Like :func:`get_auth`, but also returns the number of seconds the token
+    is good for, or None if the auth server didn't say.
+    """
     parsed, conn = http_connection(url)
     conn.request('GET', parsed.path, '',
                  {'X-Auth-User': user, 'X-Auth-Key': key})
@@ -194,8 +300,111 @@ def get_auth(url, user, key, snet=False):
         # Second item in the list is the netloc
         parsed[1] = 'snet-' + parsed[1]
         url = urlunparse(parsed)
-    return url, resp.getheader('x-storage-token',
-                                                resp.getheader('x-auth-token'))
+    expires = resp.getheader('x-auth-token-expires')
+    if expires is not None:
+        try:
+            expires = float(expires)
+        except ValueError:
+            expires = None
+    token = resp.getheader('x-storage-token', resp.getheader('x-auth-token'))
+    return url, token, expires
+
+
+class Credentials(object):
+    """
+    Storage URL and auth token shared by every :class:`Connection` for the
+    same account, so that an expired token is renewed by one request instead
+    of one per connection. Use :func:`get_credentials` to get the shared
+    instance.
+    """
+
+    def __init__(self, authurl, user, key, snet=False, margin=60):
+        """
+        :param margin: seconds before a token expires at which to renew it;
+                       capped at half the token's lifetime
+        """
+        self.authurl = authurl
+        self.user = user
+        self.key = key
+        self.snet = snet
+        self.margin = margin
+        # (storage URL, token) is swapped as one value so readers never see
+        # a URL and token from different auth responses.
+        self.auth = (None, None)
+        self.renew_at = self.expires_at = None
+        self.lock = Lock()
+
+    def fresh(self, token):
+        """Returns True if token is current and not yet due for renewal."""
+        return bool(token) and token == self.auth[1] and \
+            (self.renew_at is None or time() < self.renew_at)
+
+    def get(self):
+        """
+        Returns (storage URL, auth token), authenticating first if needed.
+        Only one thread authenticates at a time; the others wait for its
+        result. A token that is due for renewal but not yet expired is still
+        handed out while some thread renews it.
+
+        :raises ClientException: HTTP GET request to auth URL failed
+        """
+        auth = self.auth
+        if self.fresh(auth[1]):
+            return auth
+        if auth[1] and self.expires_at and time() < self.expires_at:
+            if not self.lock.acquire(False):
+                return auth
+        else:
+            self.lock.acquire()
+        try:
+            if not self.fresh(self.auth[1]):
+                url, token, expires = _get_auth(self.authurl, self.user,
+                                                self.key, snet=self.snet)
+                now = time()
+                if expires is None:
+                    self.renew_at = self.expires_at = None
+                else:
+                    self.expires_at = now + expires
+                    self.renew_at = now + expires - \
+                        min(self.margin, expires / 2)
+                self.auth = (url, token)
+            return self.auth
+        finally:
+            self.lock.release()
+
+    def seed(self, url, token):
+        """
+        Starts from a storage URL and token obtained elsewhere, such as a
+        connection's preauthurl and preauthtoken, unless a token is already
+        known. Its expiry is unknown, so it's used until it's refused.
+        """
+        with self.lock:
+            if not self.auth[1]:
+                self.auth = (url, token)
+                self.renew_at = self.expires_at = None
+
+    def invalidate(self, token):
+        """
+        Forgets token after it was refused, unless it was already replaced;
+        the next :meth:`get` authenticates again.
+        """
+        with self.lock:
+            if token == self.auth[1]:
+                self.auth = (self.auth[0], None)
+                self.renew_at = self.expires_at = None
+
+
+_credentials = {}
+_credentials_lock = Lock()
+
+
+def get_credentials(authurl, user, key, snet=False):
+    """Returns the process wide :class:`Credentials` for the account."""
+    with _credentials_lock:
+        ident = (authurl, user, key, snet)
+        if ident not in _credentials:
+            _credentials[ident] = Credentials(authurl, user, key, snet=snet)
+        return _credentials[ident]
 
 
 def get_account(url, token, marker=None, limit=None, prefix=None,
@@ -312,7 +521,7 @@ def post_account(url, token, headers, http_conn=None):
 
 def get_container(url, token, container, marker=None, limit=None,
                   prefix=None, delimiter=None, http_conn=None,
-                  full_listing=False):
+                  full_listing=False, end_marker=None):
     """
     Get a listing of objects for the container.
 
@@ -327,6 +536,7 @@ def get_container(url, token, container, marker=None, limit=None,
                       conn object)
     :param full_listing: if True, return a full listing, else returns a max
                          of 10000 listings
+    :param end_marker: end_marker query; only names less than this are listed
     :returns: a tuple of (response headers, a list of objects) The response
               headers will be a dict and all header names will be lowercase.
     :raises ClientException: HTTP GET request failed
@@ -335,7 +545,7 @@ def get_container(url, token, container, marker=None, limit=None,
         http_conn = http_connection(url)
     if full_listing:
         rv = get_container(url, token, container, marker, limit, prefix,
-                           delimiter, http_conn)
+                           delimiter, http_conn, end_marker=end_marker)
         listing = rv[1]
         while listing:
             if not delimiter:
@@ -343,7 +553,8 @@ def get_container(url, token, container, marker=None, limit=None,
             else:
                 marker = listing[-1].get('name', listing[-1].get('subdir'))
             listing = get_container(url, token, container, marker, limit,
-                                    prefix, delimiter, http_conn)[1]
+                                    prefix, delimiter, http_conn,
+                                    end_marker=end_marker)[1]
             if listing:
                 rv[1].extend(listing)
         return rv
@@ -358,6 +569,8 @@ def get_container(url, token, container, marker=None, limit=None,
         qs += '&prefix=%s' % quote(prefix)
     if delimiter:
         qs += '&delimiter=%s' % quote(delimiter)
+    if end_marker:
+        qs += '&end_marker=%s' % quote(end_marker)
     conn.request('GET', '%s?%s' % (path, qs), '', {'X-Auth-Token': token})
     resp = conn.getresponse()
     if resp.status < 200 or resp.status >= 300:
@@ -492,7 +705,7 @@ def delete_container(url, token, container, http_conn=None):
 
 
 def get_object(url, token, container, name, http_conn=None,
-               resp_chunk_size=None):
+               resp_chunk_size=None, headers=None):
     """
     Get an object
 
@@ -506,6 +719,9 @@ def get_object(url, token, container, name, http_conn=None,
                             you specify a resp_chunk_size you must fully read
                             the object's contents before making another
                             request.
+    :param headers: additional headers to include in the request, such as
+                    If-None-Match (a 304 response raises a ClientException
+                    with http_status 304)
     :returns: a tuple of (response headers, the object's contents) The response
               headers will be a dict and all header names will be lowercase.
     :raises ClientException: HTTP GET request failed
@@ -515,7 +731,10 @@ def get_object(url, token, container, name, http_conn=None,
     else:
         parsed, conn = http_connection(url)
     path = '%s/%s/%s' % (parsed.path, quote(container), quote(name))
-    conn.request('GET', path, '', {'X-Auth-Token': token})
+    if not headers:
+        headers = {}
+    headers['X-Auth-Token'] = token
+    conn.request('GET', path, '', headers)
     resp = conn.getresponse()
     if resp.status < 200 or resp.status >= 300:
         resp.read()
@@ -570,9 +789,36 @@ def head_object(url, token, container, name, http_conn=None):
     return resp_headers
 
 
+# Seconds to wait for 100 Continue before sending a request body anyway.
+EXPECT_TIMEOUT = 1
+
+
+def _await_continue(conn, timeout=EXPECT_TIMEOUT):
+    """
+    Waits up to timeout seconds for the server to answer a request sent with
+    Expect: 100-continue.
+
+    :returns: None if the body should be sent, or the final response if the
+              server answered without asking for the body
+    """
+    if not select([conn.sock], [], [], timeout)[0]:
+        return None
+    resp = conn.response_class(conn.sock, method='PUT')
+    status_line = resp._read_status()
+    if status_line[1] == CONTINUE:
+        while resp.fp.readline().strip():
+            pass
+        return None
+    # Hand the status line already read back to the normal parsing.
+    resp._read_status = lambda: status_line
+    resp.begin()
+    return resp
+
+
 def put_object(url, token, container, name, contents, content_length=None,
                etag=None, chunk_size=65536, content_type=None, headers=None,
-               http_conn=None):
+               http_conn=None, delete_at=None, delete_after=None,
+               expect_continue=False):
     """
     Put an object
 
@@ -589,6 +835,12 @@ def put_object(url, token, container, name, contents, content_length=None,
     :param headers: additional headers to include in the request
     :param http_conn: HTTP connection object (If None, it will create the
                       conn object)
+    :param delete_at: unix time at which the cluster should delete the object
+    :param delete_after: number of seconds after which the cluster should
+                         delete the object
+    :param expect_continue: for file like contents, send Expect: 100-continue
+                            and don't send the body if the server refuses the
+                            request up front
     :returns: etag from server response
     :raises ClientException: HTTP PUT request failed
     """
@@ -600,6 +852,10 @@ def put_object(url, token, container, name, contents, content_length=None,
     if not headers:
         headers = {}
     headers['X-Auth-Token'] = token
+    if delete_at is not None:
+        headers['X-Delete-At'] = str(int(delete_at))
+    if delete_after is not None:
+        headers['X-Delete-After'] = str(int(delete_after))
     if etag:
         headers['ETag'] = etag.strip('"')
     if content_length is not None:
@@ -608,20 +864,25 @@ def put_object(url, token, container, name, contents, content_length=None,
         headers['Content-Type'] = content_type
     if not contents:
         headers['Content-Length'] = '0'
+    resp = None
     if hasattr(contents, 'read'):
+        if expect_continue:
+            headers['Expect'] = '100-continue'
         conn.putrequest('PUT', path)
         for header, value in headers.iteritems():
             conn.putheader(header, value)
         if content_length is None:
             conn.putheader('Transfer-Encoding', 'chunked')
-            conn.endheaders()
+        conn.endheaders()
+        if expect_continue:
+            resp = _await_continue(conn)
+        if resp is None and content_length is None:
             chunk = contents.read(chunk_size)
             while chunk:
                 conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
                 chunk = contents.read(chunk_size)
             conn.send('0\r\n\r\n')
-        else:
-            conn.endheaders()
+        elif resp is None:
             left = content_length
             while left > 0:
                 size = chunk_size
@@ -632,8 +893,13 @@ def put_object(url, token, container, name, contents, content_length=None,
                 left -= len(chunk)
     else:
         conn.request('PUT', path, contents, headers)
-    resp = conn.getresponse()
-    resp.read()
+    if resp is not None:
+        resp.read()
+        # The body was never sent, so the connection can't be reused.
+        conn.close()
+    else:
+        resp = conn.getresponse()
+        resp.read()
     if resp.status < 200 or resp.status >= 300:
         raise ClientException('Object PUT failed', http_scheme=parsed.scheme,
                 http_host=conn.host, http_port=conn.port, http_path=path,
@@ -641,6 +907,176 @@ def put_object(url, token, container, name, contents, content_length=None,
     return resp.getheader('etag').strip('"')
 
 
+class _HashingReader(object):
+    """ File-like wrapper that keeps the MD5 and length of everything read
+        through it. """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.md5sum = md5()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self.fp.read(size)
+        self.md5sum.update(chunk)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def put_object_stream(url, token, container, name, stream, chunk_size=65536,
+                      content_type=None, headers=None, http_conn=None,
+                      delete_at=None, delete_after=None,
+                      expect_continue=False):
+    """
+    Put an object read from a stream of unknown length, such as a pipe or an
+    HTTP request body, using chunked transfer encoding. The MD5 of the data is
+    computed while it is sent and checked against the ETag the server returns.
+
+    :param url: storage URL
+    :param token: auth token
+    :param container: container name that the object is in
+    :param name: object name to put
+    :param stream: a file like object to read object data from until EOF
+    :param chunk_size: chunk size of data to write
+    :param content_type: value to send as content-type header
+    :param headers: additional headers to include in the request
+    :param http_conn: HTTP connection object (If None, it will create the
+                      conn object)
+    :param delete_at: unix time at which the cluster should delete the object
+    :param delete_after: number of seconds after which the cluster should
+                         delete the object
+    :param expect_continue: send Expect: 100-continue (see :func:`put_object`)
+    :returns: etag from server response
+    :raises ClientException: HTTP PUT request failed or the returned etag
+                             doesn't match the data sent
+    """
+    if isinstance(stream, _HashingReader):
+        reader = stream
+    else:
+        reader = _HashingReader(stream)
+    etag = put_object(url, token, container, name, reader,
+                      chunk_size=chunk_size, content_type=content_type,
+                      headers=headers, http_conn=http_conn,
+                      delete_at=delete_at, delete_after=delete_after,
+                      expect_continue=expect_continue)
+    if etag != reader.md5sum.hexdigest():
+        raise ClientException('Object PUT failed: md5sum != etag, %s != %s' %
+                              (reader.md5sum.hexdigest(), etag),
+                              http_path='%s/%s' % (container, name))
+    return etag
+
+
+class _TarStream(object):
+    """ File-like object that produces a tar archive of local files as it is
+        read, so the archive never has to be staged on disk. """
+
+    def __init__(self, files, chunk_size=65536):
+        self._chunks = self._archive(files, chunk_size)
+        self._buf = ''
+
+    def _archive(self, files, chunk_size):
+        for path, name in files:
+            if isinstance(name, unicode):
+                name = name.encode('utf8')
+            fp = open(path, 'rb')
+            try:
+                stat = fstat(fp.fileno())
+                info = TarInfo(name)
+                info.size = stat.st_size
+                info.mtime = stat.st_mtime
+                info.mode = 0644
+                # Clusters that understand pax headers store this as the
+                # object's x-object-meta-mtime, just like a single PUT.
+                info.pax_headers = {
+                    'SCHILY.xattr.user.meta.mtime': str(stat.st_mtime)}
+                yield info.tobuf(PAX_FORMAT, 'utf8', 'strict')
+                left = info.size
+                while left > 0:
+                    chunk = fp.read(min(chunk_size, left))
+                    if not chunk:
+                        raise IOError('%s changed size while being archived'
+                                      % path)
+                    left -= len(chunk)
+                    yield chunk
+                if info.size % BLOCKSIZE:
+                    yield '\0' * (BLOCKSIZE - info.size % BLOCKSIZE)
+            finally:
+                fp.close()
+        yield '\0' * (BLOCKSIZE * 2)
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += self._chunks.next()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buf)
+        chunk = self._buf[:size]
+        self._buf = self._buf[size:]
+        return chunk
+
+
+def put_archive(url, token, container, files, chunk_size=65536,
+                http_conn=None):
+    """
+    Upload many local files with one request by streaming them as a tar
+    archive to the cluster's extract-archive (bulk) middleware.
+
+    :param url: storage URL
+    :param token: auth token
+    :param container: container name to extract the archive into
+    :param files: list of (local path, object name) tuples to archive
+    :param chunk_size: chunk size of data to write
+    :param http_conn: HTTP connection object (If None, it will create the
+                      conn object)
+    :returns: a tuple of (number of objects created, list of (object name,
+              status) for the files that failed to extract)
+    :raises ClientException: HTTP PUT request failed, or the response wasn't
+                             an extract-archive report (the middleware
+                             isn't installed)
+    """
+    if http_conn:
+        parsed, conn = http_conn
+    else:
+        parsed, conn = http_connection(url)
+    path = '%s/%s' % (parsed.path, quote(container))
+    qs = 'extract-archive=tar'
+    conn.putrequest('PUT', '%s?%s' % (path, qs))
+    conn.putheader('X-Auth-Token', token)
+    conn.putheader('Accept', 'application/json')
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    archive = _TarStream(files, chunk_size)
+    chunk = archive.read(chunk_size)
+    while chunk:
+        conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+        chunk = archive.read(chunk_size)
+    conn.send('0\r\n\r\n')
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException('Archive PUT failed', http_scheme=parsed.scheme,
+                http_host=conn.host, http_port=conn.port, http_path=path,
+                http_query=qs, http_status=resp.status,
+                http_reason=resp.reason)
+    try:
+        report = json_loads(body)
+        created = int(report['Number Files Created'])
+    except Exception:
+        raise ClientException('Archive PUT failed: extract-archive not '
+                'supported', http_scheme=parsed.scheme, http_host=conn.host,
+                http_port=conn.port, http_path=path, http_query=qs,
+                http_status=resp.status, http_reason=resp.reason)
+    failed = []
+    for name, status in report.get('Errors') or []:
+        name = unquote(name.encode('utf8')).lstrip('/')
+        if name.startswith(container + '/'):
+            name = name[len(container) + 1:]
+        failed.append((name, status))
+    return created, failed
+
+
 def post_object(url, token, container, name, headers, http_conn=None):
     """
     Update object metadata
@@ -669,6 +1105,102 @@ def post_object(url, token, container, name, headers, http_conn=None):
                 http_status=resp.status, http_reason=resp.reason)
 
 
+def copy_object(url, token, container, name, destination_container,
+                destination_name, headers=None, http_conn=None):
+    """
+    Copy an object inside the cluster with an X-Copy-From PUT; the data never
+    leaves the cluster and the object's metadata is carried over.
+
+    :param url: storage URL
+    :param token: auth token
+    :param container: container name that the source object is in
+    :param name: name of the object to copy
+    :param destination_container: container name to copy the object into
+    :param destination_name: object name to copy the object to
+    :param headers: additional headers to include in the request; metadata
+                    given here is merged into the copied metadata
+    :param http_conn: HTTP connection object (If None, it will create the
+                      conn object)
+    :returns: etag from server response
+    :raises ClientException: HTTP PUT request failed
+    """
+    if http_conn:
+        parsed, conn = http_conn
+    else:
+        parsed, conn = http_connection(url)
+    path = '%s/%s/%s' % (parsed.path, quote(destination_container),
+                         quote(destination_name))
+    if not headers:
+        headers = {}
+    headers['X-Auth-Token'] = token
+    headers['X-Copy-From'] = '/%s/%s' % (quote(container), quote(name))
+    headers['Content-Length'] = '0'
+    conn.request('PUT', path, '', headers)
+    resp = conn.getresponse()
+    resp.read()
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException('Object COPY failed', http_scheme=parsed.scheme,
+                http_host=conn.host, http_port=conn.port, http_path=path,
+                http_status=resp.status, http_reason=resp.reason)
+    return (resp.getheader('etag') or '').strip('"')
+
+
+def temp_url(url, container, name, key, expires, method='GET'):
+    """
+    Make a TempURL for an object: a URL that allows method on the object
+    without an auth token until expires. The signature is computed locally,
+    so any number of URLs can be made without a request to the cluster.
+
+    :param url: storage URL
+    :param container: container name that the object is in
+    :param name: object name
+    :param key: the account's X-Account-Meta-Temp-Url-Key
+    :param expires: unix time at which the URL stops working
+    :param method: HTTP method the URL is good for
+    :returns: the signed URL
+    """
+    if isinstance(container, unicode):
+        container = container.encode('utf8')
+    if isinstance(name, unicode):
+        name = name.encode('utf8')
+    parsed = urlparse(url)
+    path = '%s/%s/%s' % (parsed.path, quote(container), quote(name))
+    # The cluster checks the signature against the unquoted path.
+    sig = hmac_new(key, '%s\n%d\n%s' % (method, expires, unquote(path)),
+                   sha1).hexdigest()
+    return '%s://%s%s?temp_url_sig=%s&temp_url_expires=%d' % (
+        parsed.scheme, parsed.netloc, path, sig, expires)
+
+
+def form_post(url, container, prefix, key, expires, redirect='',
+              max_file_size=0, max_file_count=1):
+    """
+    Sign a FormPOST form, which lets a browser upload up to max_file_count
+    files of at most max_file_size bytes each straight into the container,
+    under names starting with prefix, until expires. Like temp_url, the
+    signature is computed locally.
+
+    :param url: storage URL
+    :param container: container name the files go in
+    :param prefix: prefix put in front of the uploaded file names
+    :param key: the account's X-Account-Meta-Temp-Url-Key
+    :param expires: unix time at which the form stops working
+    :param redirect: URL the browser is sent to after the upload
+    :param max_file_size: largest file allowed, in bytes
+    :param max_file_count: most files allowed in one post
+    :returns: (form action URL, signature)
+    """
+    if isinstance(container, unicode):
+        container = container.encode('utf8')
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode('utf8')
+    parsed = urlparse(url)
+    path = '%s/%s/%s' % (parsed.path, quote(container), quote(prefix))
+    sig = hmac_new(key, '%s\n%s\n%d\n%d\n%d' % (unquote(path), redirect,
+        max_file_size, max_file_count, expires), sha1).hexdigest()
+    return '%s://%s%s' % (parsed.scheme, parsed.netloc, path), sig
+
+
 def delete_object(url, token, container, name, http_conn=None):
     """
     Delete object
@@ -696,11 +1228,421 @@ def delete_object(url, token, container, name, http_conn=None):
                 http_reason=resp.reason)
 
 
+class ObjectCache(object):
+    """
+    On-disk read-through cache of object contents, keyed by container and
+    object name. Cached objects are revalidated with If-None-Match, so an
+    unchanged object costs one request and no body. Entries are evicted
+    least recently used first to stay within max_bytes.
+    """
+
+    def __init__(self, path, max_bytes, link=False):
+        """
+        :param path: directory to keep the cache in
+        :param max_bytes: most bytes of object contents to keep cached
+        :param link: hardlink files into and out of the cache instead of
+                     copying them; a cached file that then changes in place
+                     is noticed by its mtime and dropped
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.link = link
+        self.lock = Lock()
+        # key -> size, least recently used first
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        if not isdir(path):
+            makedirs(path)
+        found = []
+        for name in listdir(path):
+            if not name.endswith('.meta'):
+                if name.endswith('.tmp'):
+                    self._unlink(join(path, name))
+                continue
+            key = name[:-len('.meta')]
+            try:
+                size = getsize(join(path, key))
+                used = getmtime(join(path, name))
+            except OSError:
+                self._unlink(join(path, name))
+                continue
+            found.append((used, key, size))
+        for _junk, key, size in sorted(found):
+            self.entries[key] = size
+            self.bytes_used += size
+
+    def _key(self, container, name):
+        if isinstance(container, unicode):
+            container = container.encode('utf8')
+        if isinstance(name, unicode):
+            name = name.encode('utf8')
+        return md5('%s/%s' % (container, name)).hexdigest()
+
+    def _unlink(self, path):
+        try:
+            unlink(path)
+        except OSError, err:
+            if err.errno != ENOENT:
+                raise
+
+    def _drop(self, key):
+        with self.lock:
+            size = self.entries.pop(key, None)
+            if size is not None:
+                self.bytes_used -= size
+        self._unlink(join(self.path, key + '.meta'))
+        self._unlink(join(self.path, key))
+
+    def get_headers(self, container, name):
+        """
+        Returns the response headers stored with a cached object, or None if
+        the object isn't cached.
+        """
+        key = self._key(container, name)
+        if key not in self.entries:
+            return None
+        headers = {}
+        try:
+            fp = open(join(self.path, key + '.meta'))
+            for line in fp:
+                header, value = line.rstrip('\n').split(': ', 1)
+                headers[header] = value
+            fp.close()
+            # Guard against a cached file changed in place, directly or
+            # through a hardlink.
+            st = os_stat(join(self.path, key))
+            if st.st_size != int(headers.get('content-length', -1)) or \
+                    repr(st.st_mtime) != headers.pop('cached-mtime', None):
+                raise ValueError('cached file changed')
+        except (IOError, OSError, ValueError):
+            self._drop(key)
+            return None
+        return headers
+
+    def conditional_headers(self, container, name):
+        """
+        Returns request headers asking for the object only if it differs
+        from the cached copy.
+        """
+        headers = self.get_headers(container, name)
+        if headers and headers.get('etag'):
+            return {'If-None-Match': headers['etag']}
+        return {}
+
+    def restore(self, container, name, dest_path):
+        """
+        Places a copy of the cached contents of an object at dest_path, or
+        a hardlink to them if the cache links.
+
+        :returns: the response headers stored with the object
+        """
+        key = self._key(container, name)
+        headers = self.get_headers(container, name)
+        if headers is None:
+            raise IOError(ENOENT, 'Object not cached', dest_path)
+        self._unlink(dest_path)
+        self._place(join(self.path, key), dest_path)
+        self._touch(key)
+        return headers
+
+    def _place(self, src_path, dest_path):
+        if self.link:
+            try:
+                link(src_path, dest_path)
+                return
+            except OSError:
+                pass
+        copyfile(src_path, dest_path)
+
+    def _touch(self, key):
+        now = time()
+        with self.lock:
+            if key in self.entries:
+                # Moves it to the most recently used end.
+                self.entries[key] = self.entries.pop(key)
+        try:
+            utime(join(self.path, key + '.meta'), (now, now))
+        except OSError:
+            pass
+
+    def store(self, container, name, headers, src_path):
+        """
+        Adds a copy of the object at src_path to the cache, or a hardlink to
+        it if the cache links, and evicts the least recently used objects if
+        needed.
+        Manifest objects and objects larger than the cache are skipped.
+        """
+        size = getsize(src_path)
+        if size > self.max_bytes or 'x-object-manifest' in headers or \
+                not headers.get('etag'):
+            return
+        key = self._key(container, name)
+        self._drop(key)
+        fd, tmp_path = mkstemp(suffix='.tmp', dir=self.path)
+        close(fd)
+        self._unlink(tmp_path)
+        self._place(src_path, tmp_path)
+        rename(tmp_path, join(self.path, key))
+        self._write_meta(key, headers, size,
+                         getmtime(join(self.path, key)))
+
+    def _write_meta(self, key, headers, size, mtime):
+        fd, tmp_path = mkstemp(suffix='.tmp', dir=self.path)
+        fp = fdopen(fd, 'w')
+        for header, value in headers.iteritems():
+            if header in ('content-type', 'etag', 'last-modified') or \
+                    header.startswith('x-object-meta-'):
+                fp.write('%s: %s\n' % (header, value))
+        fp.write('content-length: %d\n' % size)
+        fp.write('cached-mtime: %r\n' % mtime)
+        fp.close()
+        rename(tmp_path, join(self.path, key + '.meta'))
+        with self.lock:
+            self.entries[key] = size
+            self.bytes_used += size
+            evict = []
+            while self.bytes_used > self.max_bytes:
+                oldest, size = self.entries.popitem(last=False)
+                self.bytes_used -= size
+                evict.append(oldest)
+        for oldest in evict:
+            self._unlink(join(self.path, oldest + '.meta'))
+            self._unlink(join(self.path, oldest))
+
+    def get_object(self, conn, container, name, resp_chunk_size=None):
+        """
+        Read-through equivalent of :meth:`Connection.get_object`.
+
+        :param conn: Connection to fetch uncached or changed objects with
+        """
+        try:
+            headers, body = conn._retry(get_object, container, name,
+                resp_chunk_size=resp_chunk_size or 65536,
+                headers=self.conditional_headers(container, name))
+        except ClientException, err:
+            if err.http_status != 304:
+                raise
+            key = self._key(container, name)
+            headers = self.get_headers(container, name)
+            if headers is None:
+                # Evicted since it was revalidated; fetch it properly.
+                return self.get_object(conn, container, name,
+                                       resp_chunk_size)
+            self._touch(key)
+            fp = open(join(self.path, key), 'rb')
+            if not resp_chunk_size:
+                try:
+                    return headers, fp.read()
+                finally:
+                    fp.close()
+
+            def _cached_body():
+                try:
+                    buf = fp.read(resp_chunk_size)
+                    while buf:
+                        yield buf
+                        buf = fp.read(resp_chunk_size)
+                finally:
+                    fp.close()
+            return headers, _cached_body()
+
+        def _caching_body():
+            fd, tmp_path = mkstemp(suffix='.tmp', dir=self.path)
+            fp = fdopen(fd, 'wb')
+            md5sum = md5()
+            try:
+                for buf in body:
+                    fp.write(buf)
+                    md5sum.update(buf)
+                    yield buf
+                fp.close()
+                if md5sum.hexdigest() == headers.get('etag'):
+                    self.store(container, name, headers, tmp_path)
+            finally:
+                fp.close()
+                self._unlink(tmp_path)
+        if resp_chunk_size:
+            return headers, _caching_body()
+        return headers, ''.join(_caching_body())
+
+
+class Journal(object):
+    """
+    Append-only record of completed operations, one line per object giving
+    the operation, ETag, size, mtime, container and object. A run resumed
+    from the journal skips anything it records. Entries are written through
+    a buffer and synced to disk every sync_entries entries or sync_interval
+    seconds, so a crash loses at most one batch, and that batch is simply
+    redone.
+    """
+
+    def __init__(self, path, resume=False, sync_entries=1000,
+                 sync_interval=1):
+        """
+        :param path: journal file
+        :param resume: skip the entries already in the file; without it they
+                       are kept but not loaded
+        """
+        self.sync_entries = sync_entries
+        self.sync_interval = sync_interval
+        self.lock = Lock()
+        # md5 of op, container and object -> (size, mtime)
+        self.entries = {}
+        line = '\n'
+        try:
+            fp = open(path)
+            if resume:
+                for line in fp:
+                    parts = line.split()
+                    if len(parts) != 6 or not line.endswith('\n'):
+                        # Torn last line of an interrupted run
+                        continue
+                    op, _junk, size, mtime, container, obj = parts
+                    try:
+                        self.entries[self._key(op, unquote(container),
+                            unquote(obj))] = (int(size), mtime)
+                    except ValueError:
+                        continue
+            else:
+                fp.seek(0, 2)
+                if fp.tell():
+                    fp.seek(-1, 2)
+                    line = fp.read(1)
+            fp.close()
+        except IOError, err:
+            if err.errno != ENOENT:
+                raise
+        # Never truncated, so progress isn't lost to a run without --resume.
+        self.fp = open(path, 'a')
+        if not line.endswith('\n'):
+            self.fp.write('\n')
+        self.unsynced = 0
+        self.synced_at = time()
+
+    def _key(self, op, container, obj):
+        if isinstance(container, unicode):
+            container = container.encode('utf8')
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf8')
+        return md5('%s\0%s\0%s' % (op, container, obj)).digest()
+
+    def done(self, op, container, obj, size=None, mtime=None):
+        """
+        Returns True if the journal records op as done for the object, with
+        the given size and mtime if they are passed.
+        """
+        recorded = self.entries.get(self._key(op, container, obj))
+        return recorded is not None and \
+            (size is None or recorded[0] == size) and \
+            (mtime is None or recorded[1] == mtime)
+
+    def record(self, op, container, obj, etag=None, size=None, mtime=None):
+        """Records op as done for the object."""
+        line = '%s %s %d %s %s %s\n' % (op, etag and etag.strip('"') or '-',
+            size or 0, mtime or '-', quote(container, safe=''),
+            quote(obj, safe=''))
+        with self.lock:
+            if self.fp.closed:
+                # Finished after the run gave up; it's just redone.
+                return
+            self.entries[self._key(op, container, obj)] = (size or 0,
+                                                            mtime or '-')
+            self.fp.write(line)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_entries or \
+                    time() - self.synced_at >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self.fp.flush()
+        fsync(self.fp.fileno())
+        self.unsynced = 0
+        self.synced_at = time()
+
+    def close(self):
+        with self.lock:
+            if not self.fp.closed:
+                self._sync()
+                self.fp.close()
+
+
+class EndpointPool(object):
+    """
+    Storage endpoints to spread requests across in place of the host in the
+    storage URL. Each request goes to the better of two endpoints picked at
+    random, judged by recent latency and requests in flight, so faster
+    endpoints get more of the traffic. An endpoint failing eject_after
+    requests in a row is left out for eject_time seconds.
+    """
+
+    def __init__(self, endpoints, eject_after=3, eject_time=30, decay=0.3):
+        """
+        :param endpoints: list of host[:port] or scheme://host[:port]
+        :param decay: weight of the newest sample in the latency average
+        """
+        self.endpoints = list(endpoints)
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+        self.decay = decay
+        # endpoint -> [average latency, in flight, failures, ejected until]
+        self.stats = dict((e, [0.0, 0, 0, 0]) for e in self.endpoints)
+        self.lock = Lock()
+
+    def _score(self, endpoint):
+        latency, in_flight = self.stats[endpoint][:2]
+        return latency * (in_flight + 1)
+
+    def choose(self):
+        """Returns an endpoint; pass it to :meth:`release` when done."""
+        with self.lock:
+            now = time()
+            live = [e for e in self.endpoints if self.stats[e][3] <= now]
+            if not live:
+                live = [min(self.endpoints, key=lambda e: self.stats[e][3])]
+            if len(live) > 1:
+                endpoint = min(sample(live, 2), key=self._score)
+            else:
+                endpoint = live[0]
+            self.stats[endpoint][1] += 1
+            return endpoint
+
+    def release(self, endpoint, elapsed, ok=True):
+        """Records how a request sent to endpoint went."""
+        with self.lock:
+            stats = self.stats[endpoint]
+            stats[1] -= 1
+            if ok:
+                stats[2] = 0
+                if stats[0]:
+                    stats[0] += self.decay * (elapsed - stats[0])
+                else:
+                    stats[0] = elapsed
+            else:
+                stats[2] += 1
+                if stats[2] >= self.eject_after:
+                    stats[2] = 0
+                    stats[3] = time() + self.eject_time
+
+
+def endpoint_url(url, endpoint):
+    """Returns url with its scheme and host replaced by those of endpoint."""
+    parsed = urlparse(url)
+    if '://' in endpoint:
+        target = urlparse(endpoint)
+        return urlunparse((target.scheme, target.netloc) + tuple(parsed[2:]))
+    return urlunparse((parsed.scheme, endpoint) + tuple(parsed[2:]))
+
+
 class Connection(object):
     """Convenience class to make requests that will also retry the request"""
 
+    # Shared EndpointPool used when none is passed in (see --endpoints)
+    endpoints = None
+    # Send object PUT bodies only after 100 Continue (see --expect-continue)
+    expect_continue = False
+
     def __init__(self, authurl, user, key, retries=5, preauthurl=None,
-                 preauthtoken=None, snet=False):
+                 preauthtoken=None, snet=False, cache=None, endpoints=None):
         """
         :param authurl: authenitcation URL
         :param user: user name to authenticate as
@@ -710,6 +1652,9 @@ class Connection(object):
         :param preauthtoken: authentication token (if you have already
                              authenticated)
         :param snet: use SERVICENET internal network default is False
+        :param cache: :class:`ObjectCache` to serve get_object through
+        :param endpoints: :class:`EndpointPool` to send requests to instead of
+                          the host in the storage URL
         """
         self.authurl = authurl
         self.user = user
@@ -720,11 +1665,26 @@ class Connection(object):
         self.token = preauthtoken
         self.attempts = 0
         self.snet = snet
+        self.cache = cache
+        # Without an auth URL only the preauth URL and token can be used.
+        self.credentials = None
+        if authurl:
+            self.credentials = get_credentials(authurl, user, key, snet=snet)
+            if preauthurl and preauthtoken:
+                self.credentials.seed(preauthurl, preauthtoken)
+        if endpoints is not None:
+            self.endpoints = endpoints
+        # endpoint -> kept alive connection, when using endpoints
+        self.http_conns = {}
 
     def get_auth(self):
-        return get_auth(self.authurl, self.user, self.key, snet=self.snet)
+        if not self.credentials:
+            raise ClientException('No auth URL to authenticate with')
+        return self.credentials.get()
 
-    def http_connection(self):
+    def http_connection(self, endpoint=None):
+        if endpoint:
+            return http_connection(endpoint_url(self.url, endpoint))
         return http_connection(self.url)
 
     def _retry(self, func, *args, **kwargs):
@@ -732,24 +1692,50 @@ class Connection(object):
         backoff = 1
         while self.attempts <= self.retries:
             self.attempts += 1
+            endpoint = None
             try:
-                if not self.url or not self.token:
-                    self.url, self.token = self.get_auth()
-                    self.http_conn = None
-                if not self.http_conn:
-                    self.http_conn = self.http_connection()
-                kwargs['http_conn'] = self.http_conn
-                rv = func(self.url, self.token, *args, **kwargs)
+                if self.credentials and (not self.url or
+                        not self.credentials.fresh(self.token)):
+                    url, self.token = self.get_auth()
+                    if url != self.url:
+                        self.url = url
+                        self.http_conn = None
+                        self.http_conns = {}
+                if self.endpoints:
+                    endpoint = self.endpoints.choose()
+                    self.http_conn = self.http_conns.get(endpoint)
+                start = time()
+                ok = True
+                try:
+                    if not self.http_conn:
+                        self.http_conn = self.http_connection(endpoint)
+                        if endpoint:
+                            self.http_conns[endpoint] = self.http_conn
+                    kwargs['http_conn'] = self.http_conn
+                    rv = func(self.url, self.token, *args, **kwargs)
+                except (socket.error, HTTPException):
+                    ok = False
+                    raise
+                except ClientException, err:
+                    ok = not 500 <= err.http_status <= 599
+                    raise
+                finally:
+                    if endpoint:
+                        self.endpoints.release(endpoint, time() - start, ok)
                 return rv
             except (socket.error, HTTPException):
                 if self.attempts > self.retries:
                     raise
                 self.http_conn = None
+                self.http_conns.pop(endpoint, None)
             except ClientException, err:
                 if self.attempts > self.retries:
                     raise
                 if err.http_status == 401:
-                    self.url = self.token = None
+                    if not self.credentials:
+                        raise
+                    self.credentials.invalidate(self.token)
+                    self.token = None
                     if self.attempts > 1:
                         raise
                 elif 500 <= err.http_status <= 599:
@@ -781,14 +1767,14 @@ class Connection(object):
         return self._retry(head_container, container)
 
     def get_container(self, container, marker=None, limit=None, prefix=None,
-                      delimiter=None, full_listing=False):
+                      delimiter=None, full_listing=False, end_marker=None):
         """Wrapper for :func:`get_container`"""
         # TODO(unknown): With full_listing=True this will restart the entire
         # listing with each retry. Need to make a better version that just
         # retries where it left off.
         return self._retry(get_container, container, marker=marker,
                            limit=limit, prefix=prefix, delimiter=delimiter,
-                           full_listing=full_listing)
+                           full_listing=full_listing, end_marker=end_marker)
 
     def put_container(self, container, headers=None):
         """Wrapper for :func:`put_container`"""
@@ -806,23 +1792,73 @@ class Connection(object):
         """Wrapper for :func:`head_object`"""
         return self._retry(head_object, container, obj)
 
-    def get_object(self, container, obj, resp_chunk_size=None):
+    def get_object(self, container, obj, resp_chunk_size=None,
+                   headers=None):
         """Wrapper for :func:`get_object`"""
+        if self.cache and not headers:
+            return self.cache.get_object(self, container, obj,
+                                         resp_chunk_size=resp_chunk_size)
         return self._retry(get_object, container, obj,
-                           resp_chunk_size=resp_chunk_size)
+                           resp_chunk_size=resp_chunk_size, headers=headers)
 
     def put_object(self, container, obj, contents, content_length=None,
                    etag=None, chunk_size=65536, content_type=None,
-                   headers=None):
+                   headers=None, delete_at=None, delete_after=None):
         """Wrapper for :func:`put_object`"""
         return self._retry(put_object, container, obj, contents,
             content_length=content_length, etag=etag, chunk_size=chunk_size,
-            content_type=content_type, headers=headers)
+            content_type=content_type, headers=headers, delete_at=delete_at,
+            delete_after=delete_after, expect_continue=self.expect_continue)
+
+    def put_object_stream(self, container, obj, stream, chunk_size=65536,
+                          content_type=None, headers=None, delete_at=None,
+                          delete_after=None):
+        """
+        Wrapper for :func:`put_object_stream`. A stream can't be rewound, so
+        the request is only retried while nothing has been read from it.
+        """
+        reader = _HashingReader(stream)
+
+        def _put_object_stream(url, token, *args, **kwargs):
+            if reader.bytes_read:
+                raise ClientException('Object PUT failed: stream partially '
+                                      'sent, cannot retry',
+                                      http_path='%s/%s' % (container, obj))
+            return put_object_stream(url, token, *args, **kwargs)
+
+        return self._retry(_put_object_stream, container, obj, reader,
+            chunk_size=chunk_size, content_type=content_type,
+            headers=headers, delete_at=delete_at, delete_after=delete_after,
+            expect_continue=self.expect_continue)
+
+    def put_archive(self, container, files, chunk_size=65536):
+        """Wrapper for :func:`put_archive`"""
+        return self._retry(put_archive, container, files,
+                           chunk_size=chunk_size)
+
+    def reset(self):
+        """
+        Closes the current HTTP connection, for when a request was abandoned
+        part way and left it unusable. The next request opens a new one.
+        """
+        if self.http_conn:
+            self.http_conn[1].close()
+            for endpoint, http_conn in self.http_conns.items():
+                if http_conn is self.http_conn:
+                    del self.http_conns[endpoint]
+            self.http_conn = None
 
     def post_object(self, container, obj, headers):
         """Wrapper for :func:`post_object`"""
         return self._retry(post_object, container, obj, headers)
 
+    def copy_object(self, container, obj, destination_container,
+                    destination_obj, headers=None):
+        """Wrapper for :func:`copy_object`"""
+        return self._retry(copy_object, container, obj,
+                           destination_container, destination_obj,
+                           headers=headers)
+
     def delete_object(self, container, obj):
         """Wrapper for :func:`delete_object`"""
         return self._retry(delete_object, container, obj)
@@ -840,6 +1876,9 @@ def mkdirs(path):
 
 
 class QueueFunctionThread(Thread):
+    # Set by main to have exceptions from func reported there instead of
+    # ending the thread.
+    error_queue = None
 
     def __init__(self, queue, func, *args, **kwargs):
         """ Calls func for each item in queue; func is called with a queued
@@ -857,45 +1896,886 @@ class QueueFunctionThread(Thread):
         while True:
             try:
                 item = self.queue.get_nowait()
-                if not self.abort:
-                    self.func(item, *self.args, **self.kwargs)
+                if isinstance(item, _Task):
+                    # Some job is waiting on it, so it runs even on abort.
+                    item(*self.args, **self.kwargs)
+                elif not self.abort:
+                    self._call(item)
                 self.queue.task_done()
             except Empty:
                 if self.abort:
                     break
                 sleep(0.01)
 
+    def _call(self, item):
+        try:
+            self.func(item, *self.args, **self.kwargs)
+        except Exception:
+            if self.error_queue is None or self.queue is self.error_queue:
+                raise
+            # The item failed, not the thread; carry on with the next one.
+            self.error_queue.put(format_exc().rstrip('\n'))
 
-st_delete_help = '''
-delete --all OR delete container [--leave-segments] [object] [object] ...
-    Deletes everything in the account (with --all), or everything in a
-    container, or a list of objects depending on the args given. Segments of
-    manifest objects will be deleted as well, unless you specify the
-    --leave-segments option.'''.strip('\n')
 
+class BatchedPrintThread(Thread):
+
+    def __init__(self, queue, fp, batch_size=65536):
+        """ Prints each item in queue as a line on fp; an item can also be a
+            list of lines, such as a page of a listing. Whatever has queued
+            up is joined and written at once, up to about batch_size bytes
+            at a time, so lots of short lines don't cost a write each. Use
+            the abort attribute to have the thread exit once the queue is
+            empty. """
+        Thread.__init__(self)
+        self.abort = False
+        self.queue = queue
+        self.fp = fp
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            lines = []
+            size = 0
+            while size < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+                if not isinstance(item, list):
+                    item = [item]
+                for line in item:
+                    if isinstance(line, unicode):
+                        line = line.encode('utf8')
+                    elif not isinstance(line, str):
+                        line = str(line)
+                    lines.append(line)
+                    lines.append('\n')
+                    size += len(line) + 1
+                self.queue.task_done()
+            if lines:
+                self.fp.write(''.join(lines))
+                self.fp.flush()
+            elif self.abort:
+                break
+            else:
+                sleep(0.01)
+
+
+class WriteBehindFile(object):
+
+    def __init__(self, fp, depth, hasher=None):
+        """ Wraps fp so writes are queued, up to depth chunks, and done along
+            with updating hasher on a thread of their own. The caller can
+            then go on reading the next chunks while earlier ones reach the
+            disk. Errors from the writes are raised by write or close. """
+        self.fp = fp
+        self.hasher = hasher
+        self.queue = Queue(depth)
+        self.error = None
+        self.thread = Thread(target=self._write_behind)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_behind(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.fp.write(chunk)
+                if self.hasher:
+                    self.hasher.update(chunk)
+            except Exception:
+                self.error = exc_info()
+
+    def write(self, chunk):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        self.queue.put(chunk)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fp.close()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+class SizeQueue(object):
+
+    def __init__(self, maxsize=0, threshold=0, shortest_first=False):
+        """ A bounded queue that keeps jobs of threshold bytes or more apart
+            from smaller ones. Threads take jobs through the views returned
+            by lanes(), so a share of them can be reserved for each kind of
+            job. With shortest_first, jobs are handed out smallest first
+            instead of in the order they were put. A threshold of 0 makes
+            every job small, which gives a plain FIFO queue. """
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.shortest_first = shortest_first
+        self.heaps = ([], [])
+        self.count = 0
+        self.cond = Condition()
+
+    def put(self, item, size=0):
+        large = int(bool(self.threshold) and size >= self.threshold)
+        self.cond.acquire()
+        try:
+            while self.maxsize and \
+                    len(self.heaps[0]) + len(self.heaps[1]) >= self.maxsize:
+                self.cond.wait()
+            self.count += 1
+            heappush(self.heaps[large],
+                (self.shortest_first and size or 0, self.count, item))
+        finally:
+            self.cond.release()
+
+    def get_nowait(self, order=(0, 1)):
+        self.cond.acquire()
+        try:
+            for large in order:
+                if self.heaps[large]:
+                    item = heappop(self.heaps[large])[2]
+                    self.cond.notify()
+                    return item
+            raise Empty()
+        finally:
+            self.cond.release()
+
+    def empty(self):
+        return not (self.heaps[0] or self.heaps[1])
+
+    def task_done(self):
+        pass
+
+    def lanes(self, count, small_slots=0, large_slots=0):
+        """ Returns count views for QueueFunctionThreads: small_slots that
+            only take small jobs, large_slots that only take large ones and
+            the rest taking both, alternating which kind they look at
+            first. """
+        if not self.threshold:
+            small_slots = large_slots = 0
+        return [_SizeQueueLane(self, (0,))
+                for _junk in xrange(small_slots)] + \
+            [_SizeQueueLane(self, (1,)) for _junk in xrange(large_slots)] + \
+            [_SizeQueueLane(self, (0, 1), alternate=True)
+             for _junk in xrange(count - small_slots - large_slots)]
+
+
+class _SizeQueueLane(object):
+
+    def __init__(self, queue, order, alternate=False):
+        self.queue = queue
+        self.order = order
+        self.alternate = alternate
+
+    def get_nowait(self):
+        if self.alternate:
+            self.order = self.order[::-1]
+        return self.queue.get_nowait(self.order)
+
+    def empty(self):
+        return self.queue.empty()
+
+    def task_done(self):
+        pass
+
+
+class TaskPool(object):
+
+    def __init__(self):
+        """ Child tasks that jobs running on a pool of QueueFunctionThreads
+            hand back to that same pool, instead of starting threads of their
+            own. The pool's threads read through wrap()ped queues, which
+            return queued tasks ahead of new jobs. A job waiting on its
+            TaskGroup runs queued tasks itself, so nesting never needs more
+            threads than the pool already has. """
+        self.tasks = deque()
+        self.cond = Condition()
+
+    def wrap(self, queue):
+        return _TaskPoolQueue(self, queue)
+
+    def group(self, *args, **kwargs):
+        """ Returns a TaskGroup whose tasks are called with these args when
+            the waiting job runs them itself; pool threads use their own. """
+        return TaskGroup(self, *args, **kwargs)
+
+
+class _TaskPoolQueue(object):
+
+    def __init__(self, pool, queue):
+        self.pool = pool
+        self.queue = queue
+
+    def get_nowait(self):
+        try:
+            return self.pool.tasks.popleft()
+        except IndexError:
+            return self.queue.get_nowait()
+
+    def empty(self):
+        return not self.pool.tasks and self.queue.empty()
+
+    def task_done(self):
+        # Tasks never came from the wrapped queue, so task_done is not passed
+        # on; nothing here joins queues.
+        pass
+
+
+class TaskGroup(object):
+
+    def __init__(self, pool, *args, **kwargs):
+        self.pool = pool
+        self.args = args
+        self.kwargs = kwargs
+        self.pending = 0
+        self.error = None
+
+    def submit(self, func, item):
+        """ Queues func(item, <thread args>) on the pool. """
+        with self.pool.cond:
+            self.pending += 1
+        self.pool.tasks.append(_Task(self, func, item))
+
+    def wait(self):
+        """ Runs queued tasks (this group's or others') until every task of
+            this group has finished, then re-raises the first error any of
+            them raised. """
+        while True:
+            with self.pool.cond:
+                if not self.pending:
+                    break
+            try:
+                task = self.pool.tasks.popleft()
+            except IndexError:
+                with self.pool.cond:
+                    if self.pending:
+                        self.pool.cond.wait(0.01)
+                continue
+            task(*self.args, **self.kwargs)
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+class _Task(object):
+
+    def __init__(self, group, func, item):
+        self.group = group
+        self.func = func
+        self.item = item
+
+    def __call__(self, *args, **kwargs):
+        try:
+            self.func(self.item, *args, **kwargs)
+        except Exception:
+            if not self.group.error:
+                self.group.error = exc_info()
+        finally:
+            with self.group.pool.cond:
+                self.group.pending -= 1
+                self.group.pool.cond.notify_all()
+
+
+def _mid_marker(low, high):
+    """
+    Returns a marker sorting strictly between low and high, or None if there
+    isn't room for one. A high of None stands for the end of the keyspace.
+    Markers are built from printable ASCII so they are always valid UTF-8
+    query values.
+    """
+    if isinstance(low, unicode):
+        low = low.encode('utf8')
+    if isinstance(high, unicode):
+        high = high.encode('utf8')
+    width = max(len(low), len(high or '')) + 1
+    low_value = 0
+    high_value = 0
+    for index in xrange(width):
+        low_value *= 95
+        high_value *= 95
+        if index < len(low):
+            low_value += min(max(ord(low[index]), 32), 126) - 32
+        if high is None:
+            high_value += 94
+        elif index < len(high):
+            high_value += min(max(ord(high[index]), 32), 126) - 32
+    value = (low_value + high_value + 1) // 2
+    mid = []
+    for _junk in xrange(width):
+        value, digit = divmod(value, 95)
+        mid.append(chr(digit + 32))
+    mid = ''.join(reversed(mid)).rstrip(' ')
+    if mid <= low or (high is not None and mid >= high):
+        return None
+    return mid
+
+
+def _prefix_end(prefix):
+    """
+    Returns the greatest marker any name starting with prefix can sort
+    before, or None if prefix doesn't bound the keyspace that way.
+    """
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode('utf8')
+    if prefix and ' ' <= prefix[-1] < '~':
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return None
+
+
+class _ListingRange(object):
+    """ A (low, high] slice of a container's keyspace and the listing pages
+        read from it so far. """
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.pages = deque()
+        self.done = False
+        self.next = None
+
+
+def sharded_listing(create_connection, container, prefix=None, marker=None,
+                    shards=10, max_pages=4):
+    """
+    Generator yielding the listing of a container, as get_container would
+    return it page by page, in sorted order. The keyspace is split into
+    marker/end_marker ranges that are listed concurrently by up to shards
+    threads; whenever a thread would sit idle, the range that is still being
+    listed is split at a midpoint marker and the upper half handed off. This
+    works for any naming scheme, but timestamp-prefixed names split
+    particularly cleanly.
+
+    :param create_connection: callable returning a new Connection
+    :param container: container name to list
+    :param prefix: prefix query
+    :param marker: only list names after this marker
+    :param shards: maximum number of concurrent listing requests
+    :param max_pages: most pages each thread reads ahead of the consumer
+    :raises ClientException: a listing request failed
+    """
+    cond = Condition()
+    state = {'active': 0, 'error': None, 'stop': False}
+    range_queue = Queue()
+    head = _ListingRange(marker or '', _prefix_end(prefix))
+
+    def _list_range(rng, conn):
+        with cond:
+            state['active'] += 1
+        try:
+            low = rng.low
+            while True:
+                with cond:
+                    while len(rng.pages) >= max_pages and \
+                            not state['stop'] and not state['error']:
+                        cond.wait(0.1)
+                    if state['stop'] or state['error']:
+                        break
+                high = rng.high
+                end_marker = None
+                if high is not None:
+                    # end_marker is exclusive but range ends are inclusive,
+                    # so ask for a little more and trim below.
+                    end_marker = high + ' '
+                items = conn.get_container(container, marker=low,
+                    prefix=prefix, end_marker=end_marker)[1]
+                if high is not None:
+                    items = [i for i in items
+                             if i['name'].encode('utf8') <= rng.high]
+                if not items:
+                    break
+                low = items[-1]['name'].encode('utf8')
+                with cond:
+                    rng.pages.append(items)
+                    if range_queue.empty() and state['active'] < shards:
+                        mid = _mid_marker(low, rng.high)
+                        if mid is not None:
+                            upper = _ListingRange(mid, rng.high)
+                            upper.next = rng.next
+                            rng.next = upper
+                            rng.high = mid
+                            range_queue.put(upper)
+                    cond.notify_all()
+        except Exception, err:
+            with cond:
+                state['error'] = err
+        finally:
+            with cond:
+                rng.done = True
+                state['active'] -= 1
+                cond.notify_all()
+
+    range_queue.put(head)
+    threads = [QueueFunctionThread(range_queue, _list_range,
+        create_connection()) for _junk in xrange(max(shards, 1))]
+    for thread in threads:
+        thread.start()
+    try:
+        rng = head
+        while rng:
+            with cond:
+                while not rng.pages and not rng.done and \
+                        not state['error']:
+                    cond.wait(0.1)
+                if state['error']:
+                    raise state['error']
+                if rng.pages:
+                    page = rng.pages.popleft()
+                    cond.notify_all()
+                else:
+                    rng = rng.next
+                    continue
+            yield page
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+        for thread in threads:
+            thread.abort = True
+            while thread.isAlive():
+                thread.join(0.01)
+
+
+def shard_containers(container, container_shards):
+    """
+    Returns the names of the containers a logical container is spread over
+    when it is sharded across container_shards containers.
+    """
+    if container_shards <= 1:
+        return [container]
+    return ['%s_%d' % (container, index)
+            for index in xrange(container_shards)]
+
+
+def shard_container(container, obj, container_shards):
+    """
+    Returns the container holding obj in a logical container sharded across
+    container_shards containers. The shard is picked from a hash of the
+    object name, so it's stable across runs and hosts.
+    """
+    if container_shards <= 1:
+        return container
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf8')
+    return '%s_%d' % (container,
+                      int(md5(obj).hexdigest()[:8], 16) % container_shards)
+
+
+def merged_listing(create_connection, containers, prefix=None, shards=1):
+    """
+    Generator yielding the pages of the combined listing of several
+    containers in sorted order, as if they were one container. Every
+    container is listed concurrently (each with up to shards requests of its
+    own, see :func:`sharded_listing`) and only a couple of pages per
+    container are buffered. Each item gets a 'container' key naming the
+    container it lives in.
+
+    :raises ClientException: a listing request failed, or none of the
+                             containers exist
+    """
+    job_queue = Queue()
+    page_queues = []
+    missing = []
+
+    def _list_container((container, page_queue), conn):
+        try:
+            for page in container_listing(conn, container, prefix=prefix,
+                    shards=shards, create_connection=create_connection):
+                for item in page:
+                    item['container'] = container
+                page_queue.put(page)
+        except ClientException, err:
+            if err.http_status != 404:
+                page_queue.put(err)
+            else:
+                missing.append(err)
+        except Exception, err:
+            page_queue.put(err)
+        page_queue.put(None)
+
+    def _items(index, page_queue):
+        while True:
+            page = page_queue.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            for item in page:
+                yield item['name'], index, item
+
+    for container in containers:
+        page_queue = Queue(2)
+        page_queues.append(page_queue)
+        job_queue.put((container, page_queue))
+    threads = [QueueFunctionThread(job_queue, _list_container,
+        create_connection()) for _junk in containers]
+    for thread in threads:
+        thread.start()
+    try:
+        page = []
+        for _junk, _junk, item in heapq_merge(*[_items(index, page_queue)
+                for index, page_queue in enumerate(page_queues)]):
+            page.append(item)
+            if len(page) >= 10000:
+                yield page
+                page = []
+        if page:
+            yield page
+        if len(missing) == len(containers):
+            raise missing[0]
+    finally:
+        for thread in threads:
+            thread.abort = True
+            while thread.isAlive():
+                for page_queue in page_queues:
+                    try:
+                        page_queue.get_nowait()
+                    except Empty:
+                        pass
+                thread.join(0.01)
+
+
+def container_listing(conn, container, prefix=None, shards=1,
+                      create_connection=None, container_shards=1):
+    """
+    Generator yielding the pages of a full container listing. With shards
+    greater than one the listing is done concurrently by
+    :func:`sharded_listing`; otherwise the listing is read one marker at a
+    time over conn. With container_shards greater than one, container is a
+    logical container whose shards are merged by :func:`merged_listing`.
+    """
+    if container_shards > 1 and create_connection:
+        for page in merged_listing(create_connection,
+                shard_containers(container, container_shards),
+                prefix=prefix, shards=shards):
+            yield page
+        return
+    if shards > 1 and create_connection:
+        for page in sharded_listing(create_connection, container,
+                                    prefix=prefix, shards=shards):
+            yield page
+        return
+    marker = ''
+    while True:
+        items = conn.get_container(container, marker=marker,
+                                   prefix=prefix)[1]
+        if not items:
+            break
+        yield items
+        marker = items[-1]['name']
+
+
+def report(print_queue, options, line, **record):
+    """
+    Prints line about an object, or with --format json the record as one
+    line of JSON instead. A line of None is only printed as JSON.
+    """
+    if options.format == 'json':
+        print_queue.put(json_dumps(record))
+    elif line is not None:
+        print_queue.put(line)
+
+
+def report_error(print_queue, options, start, error, **record):
+    """
+    Prints, with --format json only, the record of an object that failed
+    with status "error", the error and the seconds since start; the error
+    itself goes to stderr either way.
+    """
+    report(print_queue, options, None, status='error', error=error,
+           seconds=round(time() - start, 3), **record)
+
+
+# Extensions of the files --derivatives makes scaled copies of
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff')
+
+
+def parse_derivatives(spec):
+    """
+    Parses a --derivatives value, label:<width>x<height>[,...] where a
+    single number is used for both sides, into a list of (label, width,
+    height). Raises ValueError if spec is malformed.
+    """
+    sizes = []
+    for item in spec.split(','):
+        label, _junk, size = item.strip().partition(':')
+        width, _junk, height = size.partition('x')
+        if not label or '/' in label:
+            raise ValueError('bad derivative label %r' % label)
+        width = int(width)
+        height = int(height or width)
+        if width <= 0 or height <= 0:
+            raise ValueError('bad derivative size %r' % size)
+        sizes.append((label, width, height))
+    return sizes
+
+
+def derivative_name(obj, label):
+    """
+    Returns the name a derivative of obj is stored under: the label goes
+    between the name and its extension, so photos/a.jpg becomes
+    photos/a.thumb.jpg.
+    """
+    root, ext = splitext(obj)
+    return '%s.%s%s' % (root, label, ext)
+
+
+def make_derivatives(path, sizes):
+    """
+    Makes a copy of the image at path scaled to fit each (label, width,
+    height) in sizes, in the original's format. This runs in the
+    --derivatives process pool. Returns a list of (label, temporary file,
+    size); the caller removes the temporary files.
+    """
+    image = Image.open(path)
+    fmt = image.format
+    # Lets JPEGs be decoded at a fraction of their full size.
+    image.draft(image.mode, (max(width for _junk, width, _junk in sizes),
+                             max(height for _junk, _junk, height in sizes)))
+    image.load()
+    made = []
+    try:
+        for label, width, height in sizes:
+            copy = image.copy()
+            # PIL 1.1.7 only has the older name for the same filter.
+            copy.thumbnail((width, height),
+                           getattr(Image, 'LANCZOS', Image.ANTIALIAS))
+            if fmt == 'JPEG' and copy.mode not in ('1', 'L', 'RGB', 'CMYK'):
+                copy = copy.convert('RGB')
+            fd, tmp = mkstemp(suffix=splitext(path)[1])
+            made.append((label, tmp, 0))
+            fp = fdopen(fd, 'wb')
+            try:
+                copy.save(fp, fmt, quality=85)
+            finally:
+                fp.close()
+            made[-1] = (label, tmp, getsize(tmp))
+    except Exception:
+        for _junk, tmp, _junk in made:
+            unlink(tmp)
+        raise
+    return made
+
+
+st_copy_help = '''
+copy [options] container [object] [object] ...
+    Copies objects inside the cluster, without downloading them, to the
+    container given with -t or --to (the same container by default). Either
+    list the objects to copy or give -p or --prefix to copy every object
+    whose name starts with the prefix (or everything, without objects or a
+    prefix). --to-prefix replaces the --prefix part of the copied names, and
+    -n or --name gives the new name when copying a single object. Metadata,
+    including x-object-meta-mtime, is preserved.'''.strip('\n')
+
+
+st_move_help = '''
+move [options] container [object] [object] ...
+    Same as copy (see above) but deletes each source object once it has been
+    copied.'''.strip('\n')
+
+
+def st_move(parser, args, print_queue, error_queue):
+    st_copy(parser, args, print_queue, error_queue, move=True)
+
+
+def st_copy(parser, args, print_queue, error_queue, move=False):
+    parser.add_option('-t', '--to', dest='to_container', help='Container to '
+        'copy the objects into (default is the source container)')
+    parser.add_option('-p', '--prefix', dest='prefix', help='Will copy every '
+        'object beginning with the prefix')
+    parser.add_option('', '--to-prefix', dest='to_prefix', help='Replaces '
+        'the --prefix part of the copied object names with this')
+    parser.add_option('-n', '--name', dest='to_name', help='New name when '
+        'copying a single object')
+    (options, args) = parse_args(parser, args)
+    args = args[1:]
+    if not args:
+        error_queue.put('Usage: %s [options] %s' % (basename(argv[0]),
+                        move and st_move_help or st_copy_help))
+        return
+    if options.to_name and len(args) != 2:
+        exit('-n option only allowed for single object copies')
+    if options.to_prefix is not None and len(args) != 1:
+        exit('--to-prefix option only allowed with -p or whole containers')
+    container = args[0]
+    to_container = options.to_container or container
+    prefix = options.prefix or ''
+    to_prefix = options.to_prefix
+    if to_prefix is None:
+        to_prefix = prefix
+    if to_container == container and to_prefix == prefix and \
+            not options.to_name:
+        exit('Objects would be copied onto themselves; use -t, --to-prefix '
+             'or -n')
+
+    object_queue = Queue(10000)
+
+    def _copy_object((obj, to_obj, maybe_manifest), conn):
+        try:
+            manifest = None
+            if maybe_manifest:
+                headers = conn.head_object(container, obj)
+                manifest = headers.get('x-object-manifest')
+            if manifest:
+                # A server side copy of a manifest would join its segments
+                # into one new object. Make a second manifest for the same
+                # segments instead, so a move only deletes the source
+                # manifest and the segments stay referenced.
+                put_headers = dict((key, value)
+                    for key, value in headers.iteritems()
+                    if key.startswith('x-object-meta-'))
+                put_headers['x-object-manifest'] = manifest
+                conn.put_object(to_container, to_obj, '', content_length=0,
+                    content_type=headers.get('content-type'),
+                    headers=put_headers)
+            else:
+                conn.copy_object(container, obj, to_container, to_obj)
+            if move:
+                conn.delete_object(container, obj)
+            if options.verbose:
+                print_queue.put('%s/%s -> %s/%s' % (container, obj,
+                                                    to_container, to_obj))
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Object %s not found' %
+                            repr('%s/%s' % (container, obj)))
+
+    url, token = get_credentials(options.auth, options.user,
+        options.key, snet=options.snet).get()
+    create_connection = lambda: Connection(options.auth, options.user,
+        options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
+    object_threads = [QueueFunctionThread(object_queue, _copy_object,
+        create_connection()) for _junk in xrange(10)]
+    for thread in object_threads:
+        thread.start()
+    conn = create_connection()
+    if to_container != container:
+        try:
+            conn.put_container(to_container)
+        except Exception:
+            pass
+    if len(args) == 1:
+        # When copying within a container the copies can show up later in
+        # the same listing; skip them rather than copy them again. Only the
+        # names this run copies to are skipped, since other objects can
+        # share the --to-prefix. The listing and the copy names both come
+        # in sorted order, so names the listing has passed are dropped.
+        copies = None
+        if to_container == container and to_prefix.startswith(prefix):
+            copies = deque()
+        try:
+            for objects in container_listing(conn, container, prefix=prefix,
+                    shards=options.listing_shards,
+                    create_connection=create_connection):
+                for item in objects:
+                    obj = item['name']
+                    if copies is not None:
+                        while copies and copies[0] < obj:
+                            copies.popleft()
+                        if copies and copies[0] == obj:
+                            copies.popleft()
+                            continue
+                    to_obj = to_prefix + obj[len(prefix):]
+                    if copies is not None and to_obj > obj:
+                        copies.append(to_obj)
+                    # Manifests list with no bytes of their own.
+                    object_queue.put((obj, to_obj, not item.get('bytes')))
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Container %s not found' % repr(container))
+    elif options.to_name:
+        object_queue.put((args[1], options.to_name, True))
+    else:
+        for obj in args[1:]:
+            object_queue.put((obj, obj, True))
+    while not object_queue.empty():
+        sleep(0.01)
+    for thread in object_threads:
+        thread.abort = True
+        while thread.isAlive():
+            thread.join(0.01)
 
-def st_delete(parser, args, print_queue, error_queue):
-    parser.add_option('-a', '--all', action='store_true', dest='yes_all',
-        default=False, help='Indicates that you really want to delete '
-        'everything in the account')
-    parser.add_option('', '--leave-segments', action='store_true',
-        dest='leave_segments', default=False, help='Indicates that you want '
-        'the segments of manifest objects left alone')
-    (options, args) = parse_args(parser, args)
-    args = args[1:]
-    if (not args and not options.yes_all) or (args and options.yes_all):
-        error_queue.put('Usage: %s [options] %s' %
-                        (basename(argv[0]), st_delete_help))
-        return
+
+st_delete_help = '''
+delete --all OR delete container [--leave-segments] [object] [object] ...
+    Deletes everything in the account (with --all), or everything in a
+    container, or a list of objects depending on the args given. Segments of
+    manifest objects will be deleted as well, unless you specify the
+    --leave-segments option.'''.strip('\n')
+
+
+def st_delete(parser, args, print_queue, error_queue):
+    parser.add_option('-a', '--all', action='store_true', dest='yes_all',
+        default=False, help='Indicates that you really want to delete '
+        'everything in the account')
+    parser.add_option('', '--leave-segments', action='store_true',
+        dest='leave_segments', default=False, help='Indicates that you want '
+        'the segments of manifest objects left alone')
+    (options, args) = parse_args(parser, args)
+    args = objects_from(options, args[1:])
+    if args is None:
+        return
+    if (not args and not options.yes_all) or (args and options.yes_all):
+        error_queue.put('Usage: %s [options] %s' %
+                        (basename(argv[0]), st_delete_help))
+        return
 
     def _delete_segment((container, obj), conn):
+        start = time()
         conn.delete_object(container, obj)
         if options.verbose:
-            print_queue.put('%s/%s' % (container, obj))
+            report(print_queue, options, '%s/%s' % (container, obj),
+                   container=container, name=obj, status='deleted',
+                   seconds=round(time() - start, 3))
 
+    journal = open_journal(options)
     object_queue = Queue(10000)
+    tasks = TaskPool()
+    # container -> [object deletes outstanding, listing finished]; entries
+    # stay until the container itself has been deleted.
+    pending = {}
+    pending_lock = Lock()
+    container_delete_queue = Queue()
+
+    def _track(container):
+        with pending_lock:
+            pending.setdefault(container, [0, False])
+
+    def _forget(container):
+        with pending_lock:
+            pending.pop(container, None)
+
+    def _expect_object(container):
+        with pending_lock:
+            pending[container][0] += 1
+
+    def _object_finished(container, listing_done=False):
+        with pending_lock:
+            counts = pending.get(container)
+            if not counts:
+                return
+            if listing_done:
+                counts[1] = True
+            else:
+                counts[0] -= 1
+            ready = counts[1] and not counts[0]
+        if ready:
+            container_delete_queue.put(container)
 
     def _delete_object((container, obj), conn):
+        try:
+            _delete_object_now(container, obj, conn)
+        finally:
+            _object_finished(container)
+
+    def _delete_object_now(container, obj, conn):
+        if journal and journal.done('delete', container, obj):
+            return
+        start = time()
         try:
             old_manifest = None
             if not options.leave_segments:
@@ -907,55 +2787,72 @@ def st_delete(parser, args, print_queue, error_queue):
                         raise
             conn.delete_object(container, obj)
             if old_manifest:
-                segment_queue = Queue(10000)
+                segments = tasks.group(conn)
                 scontainer, sprefix = old_manifest.split('/', 1)
                 for delobj in conn.get_container(scontainer,
                                                  prefix=sprefix)[1]:
-                    segment_queue.put((scontainer, delobj['name']))
-                if not segment_queue.empty():
-                    segment_threads = [QueueFunctionThread(segment_queue,
-                        _delete_segment, create_connection()) for _junk in
-                        xrange(10)]
-                    for thread in segment_threads:
-                        thread.start()
-                    while not segment_queue.empty():
-                        sleep(0.01)
-                    for thread in segment_threads:
-                        thread.abort = True
-                        while thread.isAlive():
-                            thread.join(0.01)
+                    segments.submit(_delete_segment,
+                                    (scontainer, delobj['name']))
+                segments.wait()
             if options.verbose:
                 path = options.yes_all and join(container, obj) or obj
                 if path[:1] in ('/', '\\'):
                     path = path[1:]
-                print_queue.put(path)
-        except ClientException, err:
-            if err.http_status != 404:
+                report(print_queue, options, path, container=container,
+                       name=obj, status='deleted',
+                       seconds=round(time() - start, 3))
+            if journal:
+                journal.record('delete', container, obj)
+        except Exception, err:
+            missing = getattr(err, 'http_status', None) == 404
+            report_error(print_queue, options, start,
+                         missing and 'not found' or str(err),
+                         container=container, name=obj)
+            if not missing:
                 raise
             error_queue.put('Object %s not found' %
                             repr('%s/%s' % (container, obj)))
 
     container_queue = Queue(10000)
 
-    def _delete_container(container, conn):
+    def _delete_container(container, conn, container_shards=1):
+        shards = shard_containers(container, container_shards)
+        for shard in shards:
+            _track(shard)
         try:
-            marker = ''
-            while True:
-                objects = [o['name'] for o in
-                           conn.get_container(container, marker=marker)[1]]
-                if not objects:
-                    break
+            for objects in container_listing(conn, container,
+                    shards=options.listing_shards,
+                    create_connection=create_connection,
+                    container_shards=container_shards):
                 for obj in objects:
-                    object_queue.put((container, obj))
-                marker = objects[-1]
-            while not object_queue.empty():
-                sleep(0.01)
+                    shard = obj.get('container', container)
+                    _expect_object(shard)
+                    object_queue.put((shard, obj['name']))
+        except ClientException, err:
+            for shard in shards:
+                _forget(shard)
+            if err.http_status != 404:
+                raise
+            error_queue.put('Container %s not found' % repr(container))
+        except Exception:
+            for shard in shards:
+                _forget(shard)
+            raise
+        else:
+            # Each container is deleted as soon as its own objects are gone,
+            # without waiting on other containers' deletes.
+            for shard in shards:
+                _object_finished(shard, listing_done=True)
+
+    def _delete_container_now(container, conn):
+        try:
             attempts = 1
             while True:
                 try:
                     conn.delete_container(container)
                     break
                 except ClientException, err:
+                    # Listings can briefly lag behind the object deletes.
                     if err.http_status != 409:
                         raise
                     if attempts > 10:
@@ -965,62 +2862,71 @@ def st_delete(parser, args, print_queue, error_queue):
         except ClientException, err:
             if err.http_status != 404:
                 raise
-            error_queue.put('Container %s not found' % repr(container))
+        finally:
+            _forget(container)
 
-    url, token = get_auth(options.auth, options.user, options.key,
-        snet=options.snet)
-    create_connection = lambda: Connection(options.auth, options.user,
-        options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
-    object_threads = [QueueFunctionThread(object_queue, _delete_object,
-        create_connection()) for _junk in xrange(10)]
-    for thread in object_threads:
-        thread.start()
-    container_threads = [QueueFunctionThread(container_queue,
-        _delete_container, create_connection()) for _junk in xrange(10)]
-    for thread in container_threads:
-        thread.start()
-    if not args:
-        conn = create_connection()
-        try:
-            marker = ''
-            while True:
-                containers = \
-                    [c['name'] for c in conn.get_account(marker=marker)[1]]
-                if not containers:
-                    break
-                for container in containers:
-                    container_queue.put(container)
-                marker = containers[-1]
-            while not container_queue.empty():
-                sleep(0.01)
-            while not object_queue.empty():
+    try:
+        url, token = get_credentials(options.auth, options.user,
+            options.key, snet=options.snet).get()
+        create_connection = lambda: Connection(options.auth, options.user,
+            options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
+        object_threads = [QueueFunctionThread(tasks.wrap(object_queue),
+            _delete_object, create_connection()) for _junk in xrange(10)]
+        for thread in object_threads:
+            thread.start()
+        container_threads = [QueueFunctionThread(container_queue,
+            _delete_container, create_connection()) for _junk in xrange(10)]
+        for thread in container_threads:
+            thread.start()
+        container_delete_threads = [
+            QueueFunctionThread(container_delete_queue, _delete_container_now,
+                                create_connection()) for _junk in xrange(10)]
+        for thread in container_delete_threads:
+            thread.start()
+        if not args:
+            conn = create_connection()
+            try:
+                marker = ''
+                while True:
+                    containers = \
+                        [c['name'] for c in conn.get_account(marker=marker)[1]]
+                    if not containers:
+                        break
+                    for container in containers:
+                        _track(container)
+                        container_queue.put(container)
+                    marker = containers[-1]
+            except ClientException, err:
+                if err.http_status != 404:
+                    raise
+                error_queue.put('Account not found')
+        elif len(args) == 1:
+            if '/' in args[0]:
+                print >> stderr, 'WARNING: / in container name; you might ' \
+                                 'have meant %r instead of %r.' % \
+                                 (args[0].replace('/', ' ', 1), args[0])
+            conn = create_connection()
+            _delete_container(args[0], conn,
+                              container_shards=options.container_shards)
+        else:
+            for obj in args[1:]:
+                object_queue.put((shard_container(args[0], obj,
+                    options.container_shards), obj))
+        while pending:
+            sleep(0.01)
+        for queue, threads in ((container_queue, container_threads),
+                               (object_queue, object_threads),
+                               (container_delete_queue,
+                                container_delete_threads)):
+            while not queue.empty():
                 sleep(0.01)
-        except ClientException, err:
-            if err.http_status != 404:
-                raise
-            error_queue.put('Account not found')
-    elif len(args) == 1:
-        if '/' in args[0]:
-            print >> stderr, 'WARNING: / in container name; you might have ' \
-                             'meant %r instead of %r.' % \
-                             (args[0].replace('/', ' ', 1), args[0])
-        conn = create_connection()
-        _delete_container(args[0], conn)
-    else:
-        for obj in args[1:]:
-            object_queue.put((args[0], obj))
-    while not container_queue.empty():
-        sleep(0.01)
-    for thread in container_threads:
-        thread.abort = True
-        while thread.isAlive():
-            thread.join(0.01)
-    while not object_queue.empty():
-        sleep(0.01)
-    for thread in object_threads:
-        thread.abort = True
-        while thread.isAlive():
-            thread.join(0.01)
+            for thread in threads:
+                thread.abort = True
+                while thread.isAlive():
+                    thread.join(0.01)
+    finally:
+        if journal:
+            journal.close()
 
 
 st_download_help = '''
@@ -1029,7 +2935,13 @@ download --all OR download container [options] [object] [object] ...
     container, or a list of objects depending on the args given. For a single
     object download, you may use the -o [--output] <filename> option to
     redirect the output to a specific file or if "-" then just redirect to
-    stdout.'''.strip('\n')
+    stdout. --cache-dir <dir> keeps a local cache of downloaded objects that
+    are only downloaded again if they changed. --small-size <size> keeps
+    --small-slots threads for objects under <size> and --large-slots for the
+    rest; --shortest-first fetches the smallest listed objects first. Objects
+    are read in --buffer-size chunks and up to --buffer-depth of them are
+    queued for a writer thread, so reading and writing overlap.'''.strip(
+    '\n')
 
 
 def st_download(options, args, print_queue, error_queue):
@@ -1038,8 +2950,28 @@ def st_download(options, args, print_queue, error_queue):
         'everything in the account')
     parser.add_option('-o', '--output', dest='out_file', help='For a single '
         'file download, stream the output to an alternate location ')
+    parser.add_option('', '--cache-dir', dest='cache_dir', help='Will keep '
+        'downloaded objects in this directory and only download them again '
+        'if they changed')
+    parser.add_option('', '--cache-links', action='store_true',
+        dest='cache_links', default=False, help='Will hardlink files into '
+        'and out of the --cache-dir instead of copying them, so don\'t '
+        'modify downloaded files in place')
+    parser.add_option('', '--cache-size', type='int', dest='cache_size',
+        default=1073741824, help='Most bytes to keep in the --cache-dir '
+        '(default 1073741824)')
+    parser.add_option('', '--buffer-size', type='int', dest='buffer_size',
+        default=65536, help='Size of the chunks objects are read in '
+        '(default 65536)')
+    parser.add_option('', '--buffer-depth', type='int', dest='buffer_depth',
+        default=4, help='Most chunks read ahead of the writer thread; 0 '
+        'writes on the reading thread (default 4)')
     (options, args) = parse_args(parser, args)
-    args = args[1:]
+    args = objects_from(options, args[1:])
+    if args is None:
+        return
+    if options.buffer_size <= 0:
+        exit('--buffer-size must be positive')
     if options.out_file == '-':
         options.verbose = 0
     if options.out_file and len(args) != 2:
@@ -1048,8 +2980,16 @@ def st_download(options, args, print_queue, error_queue):
         error_queue.put('Usage: %s [options] %s' %
                         (basename(argv[0]), st_download_help))
         return
+    if options.small_slots + options.large_slots > 10:
+        exit('--small-slots and --large-slots may not add up to more than 10')
+    cache = None
+    if options.cache_dir:
+        cache = ObjectCache(options.cache_dir, options.cache_size,
+                            link=options.cache_links)
+    journal = open_journal(options)
 
-    object_queue = Queue(10000)
+    object_queue = SizeQueue(10000, options.small_size,
+                             options.shortest_first)
 
     def _download_object(queue_arg, conn):
         if len(queue_arg) == 2:
@@ -1059,18 +2999,55 @@ def st_download(options, args, print_queue, error_queue):
             container, obj, out_file = queue_arg
         else:
             raise Exception("Invalid queue_arg length of %s" % len(queue_arg))
+        if journal and journal.done('download', container, obj):
+            return
+        start = time()
         try:
-            headers, body = \
-                conn.get_object(container, obj, resp_chunk_size=65536)
+            path = options.yes_all and join(container, obj) or obj
+            if path[:1] in ('/', '\\'):
+                path = path[1:]
+            use_cache = cache and out_file != '-'
+            try:
+                headers, body = conn.get_object(container, obj,
+                    resp_chunk_size=options.buffer_size, headers=use_cache and
+                    cache.conditional_headers(container, obj) or None)
+            except ClientException, err:
+                if not use_cache or err.http_status != 304:
+                    raise
+                dirpath = dirname(out_file or path)
+                if dirpath and not isdir(dirpath):
+                    mkdirs(dirpath)
+                try:
+                    headers = cache.restore(container, obj, out_file or path)
+                except (IOError, OSError):
+                    headers = None
+                if headers is None:
+                    # Evicted since it was revalidated; fetch it properly.
+                    headers, body = conn.get_object(container, obj,
+                        resp_chunk_size=options.buffer_size)
+                else:
+                    if 'x-object-meta-mtime' in headers and \
+                            not options.out_file:
+                        mtime = float(headers['x-object-meta-mtime'])
+                        utime(path, (mtime, mtime))
+                    if options.verbose:
+                        report(print_queue, options, path,
+                               container=container, name=obj,
+                               path=out_file or path,
+                               bytes=int(headers.get('content-length') or 0),
+                               etag=headers.get('etag'), status='cached',
+                               seconds=round(time() - start, 3))
+                    if journal:
+                        journal.record('download', container, obj,
+                            headers.get('etag'),
+                            int(headers.get('content-length') or 0))
+                    return
             content_type = headers.get('content-type')
             if 'content-length' in headers:
                 content_length = int(headers.get('content-length'))
             else:
                 content_length = None
             etag = headers.get('etag')
-            path = options.yes_all and join(container, obj) or obj
-            if path[:1] in ('/', '\\'):
-                path = path[1:]
             md5sum = None
             make_dir = out_file != "-"
             if content_type.split(';', 1)[0] == 'text/directory':
@@ -1087,6 +3064,13 @@ def st_download(options, args, print_queue, error_queue):
                 dirpath = dirname(path)
                 if make_dir and dirpath and not isdir(dirpath):
                     mkdirs(dirpath)
+                if use_cache:
+                    # Never write through a hardlink into the cache.
+                    try:
+                        unlink(out_file or path)
+                    except OSError, err:
+                        if err.errno != ENOENT:
+                            raise
                 if out_file == "-":
                     fp = stdout
                 elif out_file:
@@ -1095,101 +3079,138 @@ def st_download(options, args, print_queue, error_queue):
                     fp = open(path, 'wb')
                 read_length = 0
                 if 'x-object-manifest' not in headers:
-                    md5sum = md5()
-                for chunk in body:
-                    fp.write(chunk)
-                    read_length += len(chunk)
-                    if md5sum:
-                        md5sum.update(chunk)
-                fp.close()
-            if md5sum and md5sum.hexdigest() != etag:
-                error_queue.put('%s: md5sum != etag, %s != %s' %
-                                (path, md5sum.hexdigest(), etag))
-            if content_length is not None and read_length != content_length:
-                error_queue.put('%s: read_length != content_length, %d != %d' %
-                                (path, read_length, content_length))
+                    md5sum = md5()
+                # Objects that fit in one chunk have nothing to overlap.
+                if options.buffer_depth > 0 and (content_length is None or
+                        content_length > options.buffer_size):
+                    fp = WriteBehindFile(fp, options.buffer_depth, md5sum)
+                    try:
+                        for chunk in body:
+                            fp.write(chunk)
+                            read_length += len(chunk)
+                    finally:
+                        fp.close()
+                else:
+                    for chunk in body:
+                        fp.write(chunk)
+                        read_length += len(chunk)
+                        if md5sum:
+                            md5sum.update(chunk)
+                    fp.close()
+            # Before the file is cached, so a hardlinked cache entry records
+            # the mtime it keeps.
             if 'x-object-meta-mtime' in headers and not options.out_file:
                 mtime = float(headers['x-object-meta-mtime'])
                 utime(path, (mtime, mtime))
-            if options.verbose:
-                print_queue.put(path)
-        except ClientException, err:
-            if err.http_status != 404:
+            error = None
+            if md5sum and md5sum.hexdigest() != etag:
+                error = '%s: md5sum != etag, %s != %s' % \
+                    (path, md5sum.hexdigest(), etag)
+                error_queue.put(error)
+            elif use_cache and md5sum and \
+                    content_type.split(';', 1)[0] != 'text/directory':
+                cache.store(container, obj, headers, out_file or path)
+            if content_length is not None and read_length != content_length:
+                error = '%s: read_length != content_length, %d != %d' % \
+                    (path, read_length, content_length)
+                error_queue.put(error)
+            record = {'container': container, 'name': obj,
+                      'path': out_file or path, 'bytes': read_length,
+                      'etag': etag, 'status': 'downloaded'}
+            if error:
+                record.update(status='error', error=error)
+            if options.verbose or error:
+                report(print_queue, options, options.verbose and path or None,
+                       seconds=round(time() - start, 3), **record)
+            if journal and not error and out_file != '-':
+                journal.record('download', container, obj, etag, read_length)
+        except Exception, err:
+            missing = getattr(err, 'http_status', None) == 404
+            report_error(print_queue, options, start,
+                         missing and 'not found' or str(err),
+                         container=container, name=obj)
+            if not missing:
                 raise
             error_queue.put('Object %s not found' %
                             repr('%s/%s' % (container, obj)))
 
     container_queue = Queue(10000)
 
-    def _download_container(container, conn):
+    def _download_container(container, conn, container_shards=1):
         try:
-            marker = ''
-            while True:
-                objects = [o['name'] for o in
-                           conn.get_container(container, marker=marker)[1]]
-                if not objects:
-                    break
+            for objects in container_listing(conn, container,
+                    shards=options.listing_shards,
+                    create_connection=create_connection,
+                    container_shards=container_shards):
                 for obj in objects:
-                    object_queue.put((container, obj))
-                marker = objects[-1]
+                    object_queue.put((obj.get('container', container),
+                                      obj['name']), obj.get('bytes', 0))
         except ClientException, err:
             if err.http_status != 404:
                 raise
             error_queue.put('Container %s not found' % repr(container))
 
-    url, token = get_auth(options.auth, options.user, options.key,
-        snet=options.snet)
-    create_connection = lambda: Connection(options.auth, options.user,
-        options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
-    object_threads = [QueueFunctionThread(object_queue, _download_object,
-        create_connection()) for _junk in xrange(10)]
-    for thread in object_threads:
-        thread.start()
-    container_threads = [QueueFunctionThread(container_queue,
-        _download_container, create_connection()) for _junk in xrange(10)]
-    for thread in container_threads:
-        thread.start()
-    if not args:
-        conn = create_connection()
-        try:
-            marker = ''
-            while True:
-                containers = [c['name']
-                              for c in conn.get_account(marker=marker)[1]]
-                if not containers:
-                    break
-                for container in containers:
-                    container_queue.put(container)
-                marker = containers[-1]
-        except ClientException, err:
-            if err.http_status != 404:
-                raise
-            error_queue.put('Account not found')
-    elif len(args) == 1:
-        if '/' in args[0]:
-            print >> stderr, 'WARNING: / in container name; you might have ' \
-                             'meant %r instead of %r.' % \
-                             (args[0].replace('/', ' ', 1), args[0])
-        _download_container(args[0], create_connection())
-    else:
-        if len(args) == 2:
-            obj = args[1]
-            object_queue.put((args[0], obj, options.out_file))
+    try:
+        url, token = get_credentials(options.auth, options.user,
+            options.key, snet=options.snet).get()
+        create_connection = lambda: Connection(options.auth, options.user,
+            options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
+        object_threads = [QueueFunctionThread(lane, _download_object,
+            create_connection()) for lane in object_queue.lanes(10,
+            options.small_slots, options.large_slots)]
+        for thread in object_threads:
+            thread.start()
+        container_threads = [QueueFunctionThread(container_queue,
+            _download_container, create_connection()) for _junk in xrange(10)]
+        for thread in container_threads:
+            thread.start()
+        if not args:
+            conn = create_connection()
+            try:
+                marker = ''
+                while True:
+                    containers = [c['name']
+                                  for c in conn.get_account(marker=marker)[1]]
+                    if not containers:
+                        break
+                    for container in containers:
+                        container_queue.put(container)
+                    marker = containers[-1]
+            except ClientException, err:
+                if err.http_status != 404:
+                    raise
+                error_queue.put('Account not found')
+        elif len(args) == 1:
+            if '/' in args[0]:
+                print >> stderr, 'WARNING: / in container name; you might ' \
+                                 'have meant %r instead of %r.' % \
+                                 (args[0].replace('/', ' ', 1), args[0])
+            _download_container(args[0], create_connection(),
+                                container_shards=options.container_shards)
         else:
-            for obj in args[1:]:
-                object_queue.put((args[0], obj))
-    while not container_queue.empty():
-        sleep(0.01)
-    for thread in container_threads:
-        thread.abort = True
-        while thread.isAlive():
-            thread.join(0.01)
-    while not object_queue.empty():
-        sleep(0.01)
-    for thread in object_threads:
-        thread.abort = True
-        while thread.isAlive():
-            thread.join(0.01)
+            if len(args) == 2:
+                obj = args[1]
+                object_queue.put((shard_container(args[0], obj,
+                    options.container_shards), obj, options.out_file))
+            else:
+                for obj in args[1:]:
+                    object_queue.put((shard_container(args[0], obj,
+                        options.container_shards), obj))
+        while not container_queue.empty():
+            sleep(0.01)
+        for thread in container_threads:
+            thread.abort = True
+            while thread.isAlive():
+                thread.join(0.01)
+        while not object_queue.empty():
+            sleep(0.01)
+        for thread in object_threads:
+            thread.abort = True
+            while thread.isAlive():
+                thread.join(0.01)
+    finally:
+        if journal:
+            journal.close()
 
 
 st_list_help = '''
@@ -1198,7 +3219,8 @@ list [options] [container]
     --prefix is an option that will only list items beginning with that prefix.
     -d or --delimiter is option (for container listings only) that will roll up
     items with the given delimiter (see Cloud Files general documentation for
-    what this means).
+    what this means). With --listing-shards <n>, container listings are split
+    into <n> key ranges that are listed concurrently.
 '''.strip('\n')
 
 
@@ -1212,13 +3234,43 @@ def st_list(options, args, print_queue, error_queue):
     args = args[1:]
     if options.delimiter and not args:
         exit('-d option only allowed for container listings')
+    if options.delimiter and options.container_shards > 1:
+        exit('-d option not allowed with --container-shards')
     if len(args) > 1:
         error_queue.put('Usage: %s [options] %s' %
                         (basename(argv[0]), st_list_help))
         return
     conn = Connection(options.auth, options.user, options.key,
         snet=options.snet)
+
+    def _print_items(items):
+        # A page goes to the print thread as one item.
+        if options.format == 'json':
+            lines = []
+            for item in items:
+                # Listings call the ETag the hash.
+                if 'hash' in item:
+                    item = dict(item)
+                    item['etag'] = item.pop('hash')
+                lines.append(json_dumps(item))
+        else:
+            lines = [item.get('name', item.get('subdir')) for item in items]
+        print_queue.put(lines)
+
     try:
+        if args and not options.delimiter and \
+                (options.listing_shards > 1 or options.container_shards > 1):
+            url, token = get_credentials(options.auth, options.user,
+                options.key, snet=options.snet).get()
+            create_connection = lambda: Connection(options.auth,
+                options.user, options.key, preauthurl=url,
+                preauthtoken=token, snet=options.snet)
+            for items in container_listing(conn, args[0],
+                    prefix=options.prefix, shards=options.listing_shards,
+                    create_connection=create_connection,
+                    container_shards=options.container_shards):
+                _print_items(items)
+            return
         marker = ''
         while True:
             if not args:
@@ -1229,8 +3281,7 @@ def st_list(options, args, print_queue, error_queue):
                     prefix=options.prefix, delimiter=options.delimiter)[1]
             if not items:
                 break
-            for item in items:
-                print_queue.put(item.get('name', item.get('subdir')))
+            _print_items(items)
             marker = items[-1].get('name', items[-1].get('subdir'))
     except ClientException, err:
         if err.http_status != 404:
@@ -1241,19 +3292,122 @@ def st_list(options, args, print_queue, error_queue):
             error_queue.put('Container %s not found' % repr(args[0]))
 
 
+def bulk_objects(options, args, print_queue, error_queue, func):
+    """
+    Runs func(conn, container, obj) on 10 threads for every object named in
+    args[1:], read from the --from-file file or listed under --prefix in
+    container args[0], printing one JSON line per object as each finishes.
+    The line holds whatever dict func returns, or the status and error of
+    a failed request, along with the seconds and attempts it took; a
+    failure never stops the run; a --prefix container that does not exist
+    is reported on error_queue.
+    """
+    url, token = get_credentials(options.auth, options.user,
+        options.key, snet=options.snet).get()
+    create_connection = lambda: Connection(options.auth, options.user,
+        options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
+
+    def _bulk_object(item, conn):
+        container, obj = item
+        # Names need not be UTF-8, which the json module insists on.
+        record = {'container': args[0].decode('utf8', 'replace'),
+                  'name': obj.decode('utf8', 'replace')}
+        start = time()
+        try:
+            record.update(func(conn, container, obj))
+        except Exception, err:
+            record['status'] = getattr(err, 'http_status', None) or None
+            if record['status'] == 404:
+                record['error'] = 'not found'
+            else:
+                record['error'] = str(err)
+        record['seconds'] = round(time() - start, 3)
+        record['attempts'] = conn.attempts
+        try:
+            print_queue.put(json_dumps(record))
+        except ValueError, err:
+            # Such as header values that are not UTF-8 either.
+            error_queue.put('Could not report %s: %s' % (repr(obj), err))
+
+    object_queue = Queue(10000)
+    object_threads = [QueueFunctionThread(object_queue, _bulk_object,
+        create_connection()) for _junk in xrange(10)]
+    for thread in object_threads:
+        thread.start()
+    try:
+        for obj in args[1:]:
+            object_queue.put((shard_container(args[0], obj,
+                options.container_shards), obj))
+        if options.from_file:
+            fp = options.from_file == '-' and stdin or \
+                open(options.from_file)
+            for line in fp:
+                obj = line.rstrip('\r\n')
+                if obj:
+                    object_queue.put((shard_container(args[0], obj,
+                        options.container_shards), obj))
+        if options.prefix is not None:
+            try:
+                for objects in container_listing(create_connection(),
+                        args[0], prefix=options.prefix,
+                        shards=options.listing_shards,
+                        create_connection=create_connection,
+                        container_shards=options.container_shards):
+                    for obj in objects:
+                        object_queue.put((obj.get('container', args[0]),
+                                          obj['name'].encode('utf8')))
+            except ClientException, err:
+                if err.http_status != 404:
+                    raise
+                error_queue.put('Container %s not found' % repr(args[0]))
+        while not object_queue.empty():
+            sleep(0.01)
+    finally:
+        for thread in object_threads:
+            thread.abort = True
+            while thread.isAlive():
+                thread.join(0.01)
+
+
 st_stat_help = '''
-stat [container] [object]
+stat [options] [container] [object] [object] ...
     Displays information for the account, container, or object depending on the
-    args given (if any).'''.strip('\n')
+    args given (if any). Several objects can be given at once, listed as args,
+    read one per line with --from-file <file> ("-" for stdin) or found with
+    -p or --prefix <prefix>. They are then HEADed concurrently and reported
+    as one JSON object per line, including those that fail, as is every
+    stat with --format json.'''.strip('\n')
 
 
 def st_stat(options, args, print_queue, error_queue):
+    parser.add_option('-p', '--prefix', dest='prefix', help='Will stat every '
+        'object whose name starts with <prefix>')
+    parser.add_option('', '--from-file', dest='from_file',
+        help='File to read object names from, one per line')
     (options, args) = parse_args(parser, args)
     args = args[1:]
+    if args and (len(args) > 2 or options.prefix is not None or
+                 options.from_file or
+                 (len(args) == 2 and options.format == 'json')):
+
+        def _stat_object(conn, container, obj):
+            headers = conn.head_object(container, obj)
+            return {'status': 200, 'headers': headers,
+                    'bytes': int(headers.get('content-length') or 0),
+                    'etag': headers.get('etag')}
+
+        bulk_objects(options, args, print_queue, error_queue, _stat_object)
+        return
     conn = Connection(options.auth, options.user, options.key)
     if not args:
         try:
             headers = conn.head_account()
+            if options.format == 'json':
+                print_queue.put(json_dumps({
+                    'account': conn.url.rsplit('/', 1)[-1], 'status': 200,
+                    'bytes': int(headers.get('x-account-bytes-used', 0)),
+                    'headers': headers}))
+                return
             if options.verbose > 1:
                 print_queue.put('''
 StorageURL: %s
@@ -1289,6 +3443,13 @@ Containers: %d
                              (args[0].replace('/', ' ', 1), args[0])
         try:
             headers = conn.head_container(args[0])
+            if options.format == 'json':
+                print_queue.put(json_dumps({
+                    'account': conn.url.rsplit('/', 1)[-1],
+                    'container': args[0], 'status': 200,
+                    'bytes': int(headers.get('x-container-bytes-used', 0)),
+                    'headers': headers}))
+                return
             object_count = int(headers.get('x-container-object-count', 0))
             bytes_used = int(headers.get('x-container-bytes-used', 0))
             print_queue.put('''
@@ -1356,6 +3517,121 @@ Write ACL: %s'''.strip('\n') % (conn.url.rsplit('/', 1)[-1], args[0],
                         (basename(argv[0]), st_stat_help))
 
 
+st_du_help = '''
+du [options] [container] [container] ...
+    Displays object counts and bytes used for the given containers, or for
+    every container in the account. Containers are HEADed concurrently and
+    reported largest first (or by name with --sort name). --by-prefix <n>
+    and --by-day break each container down by the first <n> characters of
+    the object names or by the day objects were last modified.'''.strip('\n')
+
+
+def st_du(parser, args, print_queue, error_queue):
+    parser.add_option('', '--by-prefix', type='int', dest='by_prefix',
+        default=0, help='Will break usage down by the first <n> characters '
+        'of the object names')
+    parser.add_option('', '--by-day', action='store_true', dest='by_day',
+        default=False, help='Will break usage down by the day objects were '
+        'last modified')
+    parser.add_option('', '--sort', dest='sort', default='bytes',
+        help='Sort the report by bytes (default), count or name')
+    (options, args) = parse_args(parser, args)
+    args = args[1:]
+    if options.sort not in ('bytes', 'count', 'name'):
+        exit('--sort must be one of bytes, count or name')
+    if options.by_prefix and options.by_day:
+        exit('--by-prefix and --by-day may not be combined')
+    usage = {}
+    usage_lock = Lock()
+
+    def _add_usage(key, count, bytes_used):
+        with usage_lock:
+            totals = usage.get(key)
+            if totals:
+                totals[0] += count
+                totals[1] += bytes_used
+            else:
+                usage[key] = [count, bytes_used]
+
+    container_queue = Queue(10000)
+
+    def _du_container(container, conn):
+        try:
+            if not (options.by_prefix or options.by_day):
+                headers = conn.head_container(container)
+                _add_usage(container,
+                           int(headers.get('x-container-object-count', 0)),
+                           int(headers.get('x-container-bytes-used', 0)))
+                return
+            # Only the running totals per group are kept, so memory stays
+            # bounded by the number of groups however big the container is.
+            for objects in container_listing(conn, container,
+                    shards=options.listing_shards,
+                    create_connection=create_connection):
+                groups = {}
+                for obj in objects:
+                    if options.by_day:
+                        group = obj.get('last_modified', '')[:10]
+                    else:
+                        group = obj['name'][:options.by_prefix]
+                    totals = groups.setdefault(group, [0, 0])
+                    totals[0] += 1
+                    totals[1] += obj.get('bytes', 0)
+                for group, (count, bytes_used) in groups.iteritems():
+                    _add_usage('%s/%s' % (container, group), count,
+                               bytes_used)
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Container %s not found' % repr(container))
+
+    url, token = get_credentials(options.auth, options.user,
+        options.key, snet=options.snet).get()
+    create_connection = lambda: Connection(options.auth, options.user,
+        options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
+    container_threads = [QueueFunctionThread(container_queue, _du_container,
+        create_connection()) for _junk in xrange(10)]
+    for thread in container_threads:
+        thread.start()
+    if not args:
+        conn = create_connection()
+        try:
+            marker = ''
+            while True:
+                containers = [c['name']
+                              for c in conn.get_account(marker=marker)[1]]
+                if not containers:
+                    break
+                for container in containers:
+                    container_queue.put(container)
+                marker = containers[-1]
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Account not found')
+    else:
+        for container in args:
+            container_queue.put(container)
+    while not container_queue.empty():
+        sleep(0.01)
+    for thread in container_threads:
+        thread.abort = True
+        while thread.isAlive():
+            thread.join(0.01)
+    if options.sort == 'name':
+        report = sorted(usage.iteritems())
+    elif options.sort == 'count':
+        report = sorted(usage.iteritems(), key=lambda i: (-i[1][0], i[0]))
+    else:
+        report = sorted(usage.iteritems(), key=lambda i: (-i[1][1], i[0]))
+    total_count = total_bytes = 0
+    for key, (count, bytes_used) in report:
+        print_queue.put('%12d %16d %s' % (count, bytes_used, key))
+        total_count += count
+        total_bytes += bytes_used
+    print_queue.put('%12d %16d %s' % (total_count, total_bytes, 'TOTAL'))
+
+
 st_post_help = '''
 post [options] [container] [object]
     Updates meta information for the account, container, or object depending on
@@ -1363,7 +3639,13 @@ post [options] [container] [object]
     automatically; but this is not true for accounts and objects. Containers
     also allow the -r (or --read-acl) and -w (or --write-acl) options. The -m
     or --meta option is allowed on all and used to define the user meta data
-    items to set in the form Name:Value. This option can be repeated. Example:
+    items to set in the form Name:Value. Objects also allow --delete-after
+    <seconds> and --delete-at <unix time> to have the cluster delete them.
+    Several objects can be given at once, listed as args, read one per line
+    with --from-file <file> ("-" for stdin) or found with -p or --prefix
+    <prefix>. They are then POSTed concurrently and reported as one JSON
+    object per line, including those that fail. The -m option can be
+    repeated. Example:
     post -m Color:Blue -m Size:Large'''.strip('\n')
 
 
@@ -1377,10 +3659,49 @@ def st_post(options, args, print_queue, error_queue):
     parser.add_option('-m', '--meta', action='append', dest='meta', default=[],
         help='Sets a meta data item with the syntax name:value. This option '
         'may be repeated. Example: -m Color:Blue -m Size:Large')
+    parser.add_option('', '--delete-after', type='int', dest='delete_after',
+        help='Has the cluster delete the object after this many seconds')
+    parser.add_option('', '--delete-at', type='int', dest='delete_at',
+        help='Has the cluster delete the object at this unix time')
+    parser.add_option('-p', '--prefix', dest='prefix', help='Will update '
+        'every object whose name starts with <prefix>')
+    parser.add_option('', '--from-file', dest='from_file',
+        help='File to read object names from, one per line')
     (options, args) = parse_args(parser, args)
     args = args[1:]
-    if (options.read_acl or options.write_acl) and not args:
+    bulk = args and (len(args) > 2 or options.prefix is not None or
+                     options.from_file)
+    if (options.read_acl or options.write_acl) and (not args or bulk):
         exit('-r and -w options only allowed for containers')
+    expiring = options.delete_after is not None or \
+        options.delete_at is not None
+    if expiring and len(args) != 2 and not bulk:
+        exit('--delete-after and --delete-at options only allowed for '
+             'objects')
+    if options.delete_after is not None and options.delete_at is not None:
+        exit('--delete-after and --delete-at may not be combined')
+    if bulk:
+        headers = {}
+        for item in options.meta:
+            split_item = item.split(':')
+            headers['X-Object-Meta-' + split_item[0]] = \
+                len(split_item) > 1 and split_item[1]
+        if options.delete_at is not None:
+            headers['X-Delete-At'] = str(options.delete_at)
+        if options.delete_after is not None:
+            headers['X-Delete-After'] = str(options.delete_after)
+
+        def _post_object(conn, container, obj):
+            post_headers = dict(headers)
+            if expiring and not options.meta:
+                for key, value in conn.head_object(container, obj).items():
+                    if key.startswith('x-object-meta-'):
+                        post_headers[key] = value
+            conn.post_object(container, obj, headers=post_headers)
+            return {'status': 202}
+
+        bulk_objects(options, args, print_queue, error_queue, _post_object)
+        return
     conn = Connection(options.auth, options.user, options.key)
     if not args:
         headers = {}
@@ -1420,7 +3741,17 @@ def st_post(options, args, print_queue, error_queue):
             split_item = item.split(':')
             headers['X-Object-Meta-' + split_item[0]] = \
                 len(split_item) > 1 and split_item[1]
+        if options.delete_at is not None:
+            headers['X-Delete-At'] = str(options.delete_at)
+        if options.delete_after is not None:
+            headers['X-Delete-After'] = str(options.delete_after)
         try:
+            if expiring and not options.meta:
+                # A POST replaces all of the object's metadata, so carry the
+                # existing items over when only setting the expiry.
+                for key, value in conn.head_object(args[0], args[1]).items():
+                    if key.startswith('x-object-meta-'):
+                        headers[key] = value
             conn.post_object(args[0], args[1], headers=headers)
         except ClientException, err:
             if err.http_status != 404:
@@ -1432,16 +3763,177 @@ def st_post(options, args, print_queue, error_queue):
                         (basename(argv[0]), st_post_help))
 
 
+st_tempurl_help = '''
+tempurl [options] container object [object] ...
+    Prints a TempURL for each object, which can be fetched without an auth
+    token until it expires. URLs are signed locally with the account's
+    X-Account-Meta-Temp-Url-Key (set it with st post -m Temp-Url-Key:<key>)
+    or with --temp-url-key. --expires <seconds> sets how long they last
+    (default a day) and -m or --method the HTTP method they allow (default
+    GET). With --from-file <file>, object names are also read one per line
+    from <file> ("-" for stdin).
+'''.strip('\n')
+
+
+def st_tempurl(parser, args, print_queue, error_queue):
+    parser.add_option('-m', '--method', dest='method', default='GET',
+        help='HTTP method the URLs allow')
+    parser.add_option('', '--expires', type='int', dest='expires',
+        default=86400, help='Seconds the URLs stay valid')
+    parser.add_option('', '--temp-url-key', dest='temp_url_key',
+        help='TempURL key to sign with instead of the account\'s')
+    parser.add_option('', '--from-file', dest='from_file',
+        help='File to read more object names from, one per line')
+    (options, args) = parse_args(parser, args)
+    args = args[1:]
+    if not args or (len(args) < 2 and not options.from_file):
+        error_queue.put('Usage: %s [options] %s' %
+                        (basename(argv[0]), st_tempurl_help))
+        return
+    # Signing is local, so a given key needs no more than the storage URL.
+    key = options.temp_url_key
+    url, token = get_credentials(options.auth, options.user, options.key,
+        snet=options.snet).get()
+    if not key:
+        conn = Connection(options.auth, options.user, options.key,
+            preauthurl=url, preauthtoken=token, snet=options.snet)
+        try:
+            headers = conn.head_account()
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Account not found')
+            return
+        key = headers.get('x-account-meta-temp-url-key')
+    if not key:
+        exit('No TempURL key; set one with st post -m Temp-Url-Key:<key> or '
+             'use --temp-url-key')
+    method = options.method.upper()
+    # One expiry for the whole batch
+    expires = int(time()) + options.expires
+
+    def _names():
+        for name in args[1:]:
+            yield name
+        if options.from_file:
+            fp = options.from_file == '-' and stdin or \
+                open(options.from_file)
+            for line in fp:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+
+    for name in _names():
+        print_queue.put(temp_url(url, shard_container(args[0], name,
+            options.container_shards), name, key, expires, method=method))
+
+
+st_formpost_help = '''
+formpost [options] container [prefix] ...
+    Prints a signed FormPOST form for each prefix, so browsers can upload
+    files straight into container under that prefix without an auth token.
+    Each line is the form's action URL followed by its hidden fields
+    (redirect, max_file_size, max_file_count, expires, signature) URL
+    encoded. Forms are signed locally with the account's
+    X-Account-Meta-Temp-Url-Key or with --temp-url-key. --max-file-size
+    <bytes> (default 100M), --max-file-count <count> (default 1), --redirect
+    <url> and --expires <seconds> (default an hour) set the form's limits.
+    With --from-file <file>, prefixes are also read one per line from
+    <file> ("-" for stdin). Needs the formpost middleware on the cluster.
+'''.strip('\n')
+
+
+def st_formpost(parser, args, print_queue, error_queue):
+    parser.add_option('', '--redirect', dest='redirect', default='',
+        help='URL to send the browser to after the upload')
+    parser.add_option('', '--max-file-size', type='int',
+        dest='max_file_size', default=104857600,
+        help='Largest file the forms accept, in bytes')
+    parser.add_option('', '--max-file-count', type='int',
+        dest='max_file_count', default=1,
+        help='Most files the forms accept in one post')
+    parser.add_option('', '--expires', type='int', dest='expires',
+        default=3600, help='Seconds the forms stay valid')
+    parser.add_option('', '--temp-url-key', dest='temp_url_key',
+        help='TempURL key to sign with instead of the account\'s')
+    parser.add_option('', '--from-file', dest='from_file',
+        help='File to read more prefixes from, one per line')
+    (options, args) = parse_args(parser, args)
+    args = args[1:]
+    if not args:
+        error_queue.put('Usage: %s [options] %s' %
+                        (basename(argv[0]), st_formpost_help))
+        return
+    if options.container_shards > 1:
+        # The browser picks the object names, so there's no telling which
+        # shard they'd belong in.
+        exit('formpost does not work with --container-shards')
+    # Signing is local, so a given key needs no more than the storage URL.
+    key = options.temp_url_key
+    url, token = get_credentials(options.auth, options.user, options.key,
+        snet=options.snet).get()
+    if not key:
+        conn = Connection(options.auth, options.user, options.key,
+            preauthurl=url, preauthtoken=token, snet=options.snet)
+        try:
+            headers = conn.head_account()
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Account not found')
+            return
+        key = headers.get('x-account-meta-temp-url-key')
+    if not key:
+        exit('No TempURL key; set one with st post -m Temp-Url-Key:<key> or '
+             'use --temp-url-key')
+    # One expiry for the whole batch
+    expires = int(time()) + options.expires
+
+    def _prefixes():
+        for prefix in args[1:]:
+            yield prefix
+        if options.from_file:
+            fp = options.from_file == '-' and stdin or \
+                open(options.from_file)
+            for line in fp:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+        elif len(args) == 1:
+            yield ''
+
+    for prefix in _prefixes():
+        action, sig = form_post(url, args[0], prefix, key, expires,
+            redirect=options.redirect, max_file_size=options.max_file_size,
+            max_file_count=options.max_file_count)
+        print_queue.put('%s redirect=%s&max_file_size=%d&max_file_count=%d'
+            '&expires=%d&signature=%s' % (action, quote(options.redirect, ''),
+            options.max_file_size, options.max_file_count, expires, sig))
+
+
 st_upload_help = '''
 upload [options] container file_or_directory [file_or_directory] [...]
     Uploads to the given container the files and directories specified by the
     remaining args. -c or --changed is an option that will only upload files
     that have changed since the last upload. -S <size> or --segment-size <size>
-    and --leave-segments are options as well (see --help for more).
+    and --leave-segments are options as well (see --help for more). With
+    --stdin, the single object named by the second arg is streamed from
+    standard input instead. --archive-threshold <size> packs files smaller
+    than <size> into tar archives uploaded with extract-archive. --dedup
+    turns uploads of content that already exists in the cluster into
+    server side copies. --delete-after <seconds> or --delete-at <unix time>
+    have the cluster delete the uploaded objects itself. --small-size <size>
+    keeps --small-slots threads for files under <size> and --large-slots for
+    the rest so neither kind starves the other; --shortest-first sends the
+    smallest queued files first. --derivatives label:<width>x<height>[,...]
+    also uploads a scaled copy of each image for every label, next to the
+    original as <name>.<label>.<ext>; the copies are made on a pool of
+    --derivative-processes processes (needs PIL).
 '''.strip('\n')
 
 
-def st_upload(options, args, print_queue, error_queue):
+def upload_options(parser):
+    """Adds the upload command's options to parser."""
     parser.add_option('-c', '--changed', action='store_true', dest='changed',
         default=False, help='Will only upload files that have changed since '
         'the last upload')
@@ -1455,34 +3947,325 @@ def st_upload(options, args, print_queue, error_queue):
         dest='leave_segments', default=False, help='Indicates that you want '
         'the older segments of manifest objects left alone (in the case of '
         'overwrites)')
+    parser.add_option('', '--stdin', action='store_true', dest='stdin',
+        default=False, help='Will stream a single object from standard input, '
+        'e.g. upload --stdin container object < file')
+    parser.add_option('', '--archive-threshold', type='int',
+        dest='archive_threshold', default=0, help='Will pack files smaller '
+        'than <size> bytes into tar archives that the cluster extracts into '
+        'individual objects (extract-archive), falling back to single '
+        'uploads for files that fail or clusters without the feature')
+    parser.add_option('', '--archive-size', type='int', dest='archive_size',
+        default=16777216, help='Maximum number of bytes of files to pack '
+        'into one archive (default 16777216)')
+    parser.add_option('', '--dedup', action='store_true', dest='dedup',
+        default=False, help='Will hash each file and, if an object with the '
+        'same content is already known from the container listing or the '
+        '--dedup-index, create the new object with a server side copy '
+        'instead of sending the data again')
+    parser.add_option('', '--dedup-index', dest='dedup_index', help='File '
+        'remembering the ETag and name of every object uploaded, loaded '
+        'and extended by each --dedup run')
+    parser.add_option('', '--dedup-max', type='int', dest='dedup_max',
+        default=1000000, help='Most ETags --dedup keeps in memory '
+        '(default 1000000)')
+    parser.add_option('', '--delete-after', type='int', dest='delete_after',
+        help='Has the cluster delete the uploaded objects after this many '
+        'seconds')
+    parser.add_option('', '--delete-at', type='int', dest='delete_at',
+        help='Has the cluster delete the uploaded objects at this unix time')
+    parser.add_option('', '--derivatives', dest='derivatives', help='Will '
+        'also upload copies of image files scaled to fit each '
+        'label:<width>x<height> in this comma separated list, as '
+        '<name>.<label>.<ext> next to the original')
+    parser.add_option('', '--derivative-processes', type='int',
+        dest='derivative_processes', default=0, help='Number of processes '
+        'making derivatives (default one per CPU)')
+
+
+def st_upload(options, args, print_queue, error_queue,
+              derivative_pool=None):
+    # The upload options are added by upload_options, which runs before
+    # the output threads start so derivative_pool can be forked first.
     (options, args) = parse_args(parser, args)
-    args = args[1:]
+    args = objects_from(options, args[1:])
+    if args is None:
+        return
     if len(args) < 2:
         error_queue.put('Usage: %s [options] %s' %
                         (basename(argv[0]), st_upload_help))
         return
-    object_queue = Queue(10000)
+    if options.stdin:
+        if len(args) != 2:
+            exit('--stdin option only allowed for single object uploads')
+        if options.segment_size or options.changed:
+            exit('--stdin option can not be combined with -S or -c')
+    if options.archive_threshold and options.changed:
+        exit('--archive-threshold option can not be combined with -c')
+    if options.small_slots + options.large_slots > 10:
+        exit('--small-slots and --large-slots may not add up to more than 10')
+    if options.dedup_index:
+        options.dedup = True
+    if options.dedup and options.archive_threshold:
+        exit('--dedup option can not be combined with --archive-threshold')
+    if options.delete_after is not None and options.delete_at is not None:
+        exit('--delete-after and --delete-at may not be combined')
+    # Segments and manifests are sent over time; a fixed X-Delete-At makes
+    # them all expire together.
+    expiry_headers = {}
+    if options.delete_after is not None:
+        expiry_headers['x-delete-at'] = str(int(time()) +
+                                            options.delete_after)
+    elif options.delete_at is not None:
+        expiry_headers['x-delete-at'] = str(options.delete_at)
+    if expiry_headers and options.archive_threshold:
+        exit('--delete-after and --delete-at can not be combined with '
+             '--archive-threshold')
+    derivative_sizes = None
+    if options.derivatives:
+        if options.stdin:
+            exit('--derivatives option can not be combined with --stdin')
+        if Image is None:
+            exit('--derivatives option needs the Python Imaging Library')
+        try:
+            derivative_sizes = parse_derivatives(options.derivatives)
+        except ValueError, err:
+            exit('--derivatives: %s' % err)
+    if options.stdin:
+        conn = Connection(options.auth, options.user, options.key,
+            snet=options.snet)
+        container = shard_container(args[0], args[1],
+                                    options.container_shards)
+        try:
+            conn.put_container(container)
+        except Exception:
+            pass
+        try:
+            start = time()
+            put_headers = {'x-object-meta-mtime': str(start)}
+            put_headers.update(expiry_headers)
+            etag = conn.put_object_stream(container, args[1], stdin,
+                                          headers=put_headers)
+            if options.verbose:
+                report(print_queue, options, args[1], container=args[0],
+                       name=args[1], etag=etag, status='uploaded',
+                       seconds=round(time() - start, 3))
+        except ClientException, err:
+            if err.http_status != 404:
+                raise
+            error_queue.put('Container %s not found' % repr(args[0]))
+        return
+    journal = open_journal(options)
+    object_queue = SizeQueue(10000, options.small_size,
+                             options.shortest_first)
+    # Segment uploads and deletes run as child tasks on the object threads.
+    tasks = TaskPool()
 
     def _segment_job(job, conn):
+        start = time()
         if job.get('delete', False):
             conn.delete_object(job['container'], job['obj'])
         else:
             fp = open(job['path'], 'rb')
             fp.seek(job['segment_start'])
             conn.put_object(job.get('container', args[0] + '_segments'),
-                job['obj'], fp, content_length=job['segment_size'])
+                job['obj'], fp, content_length=job['segment_size'],
+                headers=dict(expiry_headers))
         if options.verbose and 'log_line' in job:
-            print_queue.put(job['log_line'])
+            report(print_queue, options, job['log_line'],
+                   container=args[0] + '_segments', name=job['obj'],
+                   bytes=job['segment_size'], status='uploaded',
+                   seconds=round(time() - start, 3))
+
+    archive = {'files': [], 'bytes': 0, 'unsupported': False}
+    # ETag -> (container, object) of content already in the cluster.
+    dedup_index = {}
+    dedup_saved = set()
+    dedup_lock = Lock()
+
+    def _dedup_known(etag, container, obj):
+        # Bounded so a huge listing can't take all the memory.
+        if etag in dedup_index or len(dedup_index) < options.dedup_max:
+            dedup_index[etag] = (container, obj)
+
+    def _dedup_load():
+        # Runs alongside the uploads, so the first ones don't wait for the
+        # whole listing; until an ETag is loaded its content is just sent.
+        try:
+            for objects in container_listing(create_connection(), args[0],
+                    shards=options.listing_shards,
+                    create_connection=create_connection,
+                    container_shards=options.container_shards):
+                for obj in objects:
+                    if len(dedup_index) >= options.dedup_max:
+                        return
+                    # Manifests list with no bytes and the ETag of empty
+                    # content; copying one would copy the whole object.
+                    if obj.get('hash') and obj.get('bytes'):
+                        _dedup_known(obj['hash'],
+                            obj.get('container', args[0]),
+                            obj['name'].encode('utf8'))
+        except ClientException, err:
+            if err.http_status != 404:
+                print >> stderr, 'WARNING: Could not list %s for ' \
+                    '--dedup: %s' % (repr(args[0]), err)
+
+    def _dedup_remember(etag, container, obj):
+        _dedup_known(etag, container, obj)
+        if options.dedup_index and etag not in dedup_saved:
+            with dedup_lock:
+                # Past --dedup-max an ETag may just be saved more than once.
+                if len(dedup_saved) < options.dedup_max:
+                    dedup_saved.add(etag)
+                fp = open(options.dedup_index, 'a')
+                try:
+                    fp.write('%s %s %s\n' % (etag, quote(container),
+                                             quote(obj)))
+                finally:
+                    fp.close()
+
+    def _dedup_upload(conn, container, obj, path, size, put_headers):
+        if not size:
+            # Empty content has the same ETag as a manifest.
+            return conn.put_object(container, obj, '', content_length=0,
+                                   headers=put_headers)
+        md5sum = md5()
+        fp = open(path, 'rb')
+        try:
+            chunk = fp.read(65536)
+            while chunk:
+                md5sum.update(chunk)
+                chunk = fp.read(65536)
+        finally:
+            fp.close()
+        etag = md5sum.hexdigest()
+        known = dedup_index.get(etag)
+        if known:
+            # Copying onto the object itself still applies put_headers.
+            try:
+                copied = conn.copy_object(known[0], known[1], container, obj,
+                                          headers=dict(put_headers))
+                if copied == etag:
+                    _dedup_remember(etag, known[0], known[1])
+                    return etag
+            except ClientException, err:
+                if err.http_status != 404:
+                    raise
+            # The entry is stale: the object is gone or now holds other
+            # content. The upload below overwrites any bad copy and records
+            # the new object instead.
+            dedup_index.pop(etag, None)
+            with dedup_lock:
+                dedup_saved.discard(etag)
+        conn.put_object(container, obj, open(path, 'rb'),
+            content_length=size, etag=etag, headers=put_headers)
+        _dedup_remember(etag, container, obj)
+        return etag
+
+    def _is_image(path):
+        return derivative_sizes and \
+            splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+    def _put_derivatives(conn, obj, result, put_headers):
+        # Returns whether the derivatives were made; failing to upload one
+        # raises.
+        try:
+            made = result.get()
+        except Exception, err:
+            error_queue.put('Could not make derivatives of %s: %s' %
+                            (obj, err))
+            return False
+        try:
+            for label, tmp, size in made:
+                start = time()
+                dobj = derivative_name(obj, label)
+                etag = conn.put_object(shard_container(args[0], dobj,
+                    options.container_shards), dobj, open(tmp, 'rb'),
+                    content_length=size, headers=dict(put_headers))
+                if options.verbose:
+                    report(print_queue, options, dobj, container=args[0],
+                           name=dobj, bytes=size, etag=etag,
+                           status='uploaded',
+                           seconds=round(time() - start, 3))
+        finally:
+            for _junk, tmp, _junk in made:
+                unlink(tmp)
+        return True
+
+    def _discard_derivatives(result):
+        try:
+            made = result.get()
+        except Exception:
+            return
+        for _junk, tmp, _junk in made:
+            unlink(tmp)
+
+    def _archive_job(job, conn):
+        start = time()
+        failed = None
+        if not archive['unsupported']:
+            try:
+                # Each archive is extracted into a single container, so a
+                # sharded container gets one archive per shard.
+                shards = {}
+                for path, obj, _junk, _junk in job['archive']:
+                    shards.setdefault(shard_container(args[0], obj,
+                        options.container_shards), []).append((path, obj))
+                failed = {}
+                for container, files in shards.iteritems():
+                    failed.update(conn.put_archive(container, files)[1])
+            except ClientException, err:
+                if 200 <= err.http_status <= 299 and \
+                        not archive['unsupported']:
+                    archive['unsupported'] = True
+                    print >> stderr, 'WARNING: extract-archive not ' \
+                        'supported; uploading files individually'
+            except (IOError, OSError), err:
+                # A local file failed part way through the request, so the
+                # connection is left mid-body.
+                conn.reset()
+                print >> stderr, 'WARNING: Archive upload failed, ' \
+                    'uploading its files individually: %s' % err
+        for path, obj, size, mtime in job['archive']:
+            if failed is None or obj in failed:
+                _object_job((path, None, None), conn)
+                continue
+            if options.verbose:
+                # The files share the time of the archive they went in.
+                report(print_queue, options, obj, container=args[0],
+                       name=obj, bytes=size, status='uploaded',
+                       seconds=round(time() - start, 3))
+            if journal:
+                journal.record('upload', args[0], obj, size=size,
+                               mtime=str(mtime))
 
     def _object_job(job, conn):
-        path = job['path']
-        container = job.get('container', args[0])
+        # Plain files are queued as (path, size, mtime) tuples, reusing the
+        # stat done while walking; size and mtime are None when not known.
+        if isinstance(job, tuple):
+            path, size, mtime = job
+            job = {}
+        elif 'archive' in job:
+            return _archive_job(job, conn)
+        else:
+            path = job['path']
+            size = mtime = None
         dir_marker = job.get('dir_marker', False)
+        etag = None
+        derivatives = None
+        complete = True
+        start = time()
+        obj = path
+        if obj.startswith('./') or obj.startswith('.\\'):
+            obj = obj[2:]
         try:
-            obj = path
-            if obj.startswith('./') or obj.startswith('.\\'):
-                obj = obj[2:]
-            put_headers = {'x-object-meta-mtime': str(getmtime(path))}
+            if mtime is None:
+                st = os_stat(path)
+                size, mtime = st.st_size, st.st_mtime
+            container = job.get('container', shard_container(args[0], obj,
+                                options.container_shards))
+            put_headers = {'x-object-meta-mtime': str(mtime)}
+            put_headers.update(expiry_headers)
             if dir_marker:
                 if options.changed:
                     try:
@@ -1495,13 +4278,18 @@ def st_upload(options, args, print_queue, error_queue):
                                 cl == 0 and \
                                 et == 'd41d8cd98f00b204e9800998ecf8427e' and \
                                 mt == put_headers['x-object-meta-mtime']:
+                            if options.verbose:
+                                report(print_queue, options, None,
+                                    container=args[0], name=obj, bytes=0,
+                                    etag=et, status='unchanged',
+                                    seconds=round(time() - start, 3))
                             return
                     except ClientException, err:
                         if err.http_status != 404:
                             raise
-                conn.put_object(container, obj, '', content_length=0,
-                                content_type='text/directory',
-                                headers=put_headers)
+                etag = conn.put_object(container, obj, '', content_length=0,
+                                       content_type='text/directory',
+                                       headers=put_headers)
             else:
                 # We need to HEAD all objects now in case we're overwriting a
                 # manifest object and need to delete the old segments
@@ -1512,30 +4300,36 @@ def st_upload(options, args, print_queue, error_queue):
                         headers = conn.head_object(container, obj)
                         cl = int(headers.get('content-length'))
                         mt = headers.get('x-object-meta-mtime')
-                        if options.changed and cl == getsize(path) and \
+                        if options.changed and cl == size and \
                                 mt == put_headers['x-object-meta-mtime']:
+                            if options.verbose:
+                                report(print_queue, options, None,
+                                    container=args[0], name=obj, bytes=size,
+                                    etag=headers.get('etag'),
+                                    status='unchanged',
+                                    seconds=round(time() - start, 3))
                             return
                         if not options.leave_segments:
                             old_manifest = headers.get('x-object-manifest')
                     except ClientException, err:
                         if err.http_status != 404:
                             raise
-                if options.segment_size and \
-                        getsize(path) < options.segment_size:
-                    full_size = getsize(path)
-                    segment_queue = Queue(10000)
-                    segment_threads = [QueueFunctionThread(segment_queue,
-                        _segment_job, create_connection()) for _junk in
-                        xrange(10)]
-                    for thread in segment_threads:
-                        thread.start()
+                # The derivatives are made on the process pool while the
+                # original is being sent.
+                if _is_image(path):
+                    derivatives = derivative_pool.apply_async(
+                        make_derivatives, (path, derivative_sizes))
+                    derivative_headers = dict(put_headers)
+                if options.segment_size and size < options.segment_size:
+                    full_size = size
+                    segments = tasks.group(conn)
                     segment = 0
                     segment_start = 0
                     while segment_start < full_size:
                         segment_size = int(options.segment_size)
                         if segment_start + segment_size > full_size:
                             segment_size = full_size - segment_start
-                        segment_queue.put({'path': path,
+                        segments.submit(_segment_job, {'path': path,
                             'obj': '%s/%s/%s/%08d' % (obj,
                                 put_headers['x-object-meta-mtime'], full_size,
                                 segment),
@@ -1544,67 +4338,123 @@ def st_upload(options, args, print_queue, error_queue):
                             'log_line': '%s segment %s' % (obj, segment)})
                         segment += 1
                         segment_start += segment_size
-                    while not segment_queue.empty():
-                        sleep(0.01)
-                    for thread in segment_threads:
-                        thread.abort = True
-                        while thread.isAlive():
-                            thread.join(0.01)
+                    segments.wait()
                     new_object_manifest = '%s_segments/%s/%s/%s/' % (
-                        container, obj, put_headers['x-object-meta-mtime'],
+                        args[0], obj, put_headers['x-object-meta-mtime'],
                         full_size)
                     if old_manifest == new_object_manifest:
                         old_manifest = None
                     put_headers['x-object-manifest'] = new_object_manifest
-                    conn.put_object(container, obj, '', content_length=0,
-                                    headers=put_headers)
+                    etag = conn.put_object(container, obj, '',
+                        content_length=0, headers=put_headers)
+                elif options.dedup:
+                    etag = _dedup_upload(conn, container, obj, path, size,
+                                         put_headers)
                 else:
-                    conn.put_object(container, obj, open(path, 'rb'),
-                        content_length=getsize(path), headers=put_headers)
+                    etag = conn.put_object(container, obj, open(path, 'rb'),
+                        content_length=size, headers=put_headers)
                 if old_manifest:
-                    segment_queue = Queue(10000)
+                    segments = tasks.group(conn)
                     scontainer, sprefix = old_manifest.split('/', 1)
                     for delobj in conn.get_container(scontainer,
                                                      prefix=sprefix)[1]:
-                        segment_queue.put({'delete': True,
+                        segments.submit(_segment_job, {'delete': True,
                             'container': scontainer, 'obj': delobj['name']})
-                    if not segment_queue.empty():
-                        segment_threads = [QueueFunctionThread(segment_queue,
-                            _segment_job, create_connection()) for _junk in
-                            xrange(10)]
-                        for thread in segment_threads:
-                            thread.start()
-                        while not segment_queue.empty():
-                            sleep(0.01)
-                        for thread in segment_threads:
-                            thread.abort = True
-                            while thread.isAlive():
-                                thread.join(0.01)
+                    segments.wait()
+                if derivatives:
+                    result, derivatives = derivatives, None
+                    # Left out of the journal so --resume tries again.
+                    complete = _put_derivatives(conn, obj, result,
+                                                derivative_headers)
             if options.verbose:
-                print_queue.put(obj)
-        except OSError, err:
-            if err.errno != ENOENT:
+                report(print_queue, options, obj, container=args[0],
+                       name=obj, bytes=dir_marker and 0 or size, etag=etag,
+                       status='uploaded', seconds=round(time() - start, 3))
+            if journal and complete:
+                journal.record('upload', args[0], obj, etag, size,
+                               str(mtime))
+        except Exception, err:
+            missing = isinstance(err, OSError) and err.errno == ENOENT
+            report_error(print_queue, options, start,
+                         missing and 'local file not found' or str(err),
+                         container=args[0], name=obj)
+            if not missing:
                 raise
             error_queue.put('Local file %s not found' % repr(path))
+        finally:
+            if derivatives:
+                _discard_derivatives(derivatives)
 
     def _upload_dir(path):
-        names = listdir(path)
-        if not names:
-            object_queue.put({'path': path, 'dir_marker': True})
-        else:
-            for name in listdir(path):
-                subpath = join(path, name)
-                if isdir(subpath):
-                    _upload_dir(subpath)
-                else:
-                    object_queue.put({'path': subpath})
+        # Walks depth first with an explicit stack rather than recursing, so
+        # deep trees can't hit the recursion limit and only the directories
+        # currently being walked are held in memory. Each entry is stat'ed
+        # once and its size and mtime travel with the job; the bounded
+        # object_queue throttles the walk to the pace of the uploads.
+        stack = [(path, iter(listdir(path)), True)]
+        while stack:
+            dirpath, names, empty = stack[-1]
+            for name in names:
+                subpath = join(dirpath, name)
+                if empty:
+                    stack[-1] = (dirpath, names, False)
+                    empty = False
+                try:
+                    st = os_stat(subpath)
+                except OSError:
+                    # Gone or a dangling link; the job reports it.
+                    _queue_file(subpath)
+                    continue
+                if S_ISDIR(st.st_mode):
+                    stack.append((subpath, iter(listdir(subpath)), True))
+                    break
+                _queue_file(subpath, st)
+            else:
+                stack.pop()
+                if empty:
+                    object_queue.put({'path': dirpath, 'dir_marker': True})
 
-    url, token = get_auth(options.auth, options.user, options.key,
-        snet=options.snet)
+    def _queue_file(path, st=None):
+        if st is None:
+            try:
+                st = os_stat(path)
+            except OSError:
+                pass
+        size = mtime = None
+        if st is not None:
+            size, mtime = st.st_size, st.st_mtime
+        obj = path
+        if obj.startswith('./') or obj.startswith('.\\'):
+            obj = obj[2:]
+        if journal and size is not None and \
+                journal.done('upload', args[0], obj, size, str(mtime)):
+            return
+        # Images with derivatives to make are sent on their own.
+        if options.archive_threshold and not archive['unsupported'] and \
+                not _is_image(path):
+            if size is not None and size < options.archive_threshold:
+                archive['files'].append((path, obj, size, mtime))
+                archive['bytes'] += size
+                # The bulk middleware caps failures per request at 1000.
+                if archive['bytes'] >= options.archive_size or \
+                        len(archive['files']) >= 1000:
+                    _flush_archive()
+                return
+        object_queue.put((path, size, mtime), size or 0)
+
+    def _flush_archive():
+        if archive['files']:
+            object_queue.put({'archive': archive['files']}, archive['bytes'])
+            archive['files'] = []
+            archive['bytes'] = 0
+
+    url, token = get_credentials(options.auth, options.user,
+        options.key, snet=options.snet).get()
     create_connection = lambda: Connection(options.auth, options.user,
         options.key, preauthurl=url, preauthtoken=token, snet=options.snet)
-    object_threads = [QueueFunctionThread(object_queue, _object_job,
-        create_connection()) for _junk in xrange(10)]
+    object_threads = [QueueFunctionThread(tasks.wrap(lane), _object_job,
+        create_connection()) for lane in object_queue.lanes(10,
+        options.small_slots, options.large_slots)]
     for thread in object_threads:
         thread.start()
     conn = create_connection()
@@ -1613,17 +4463,38 @@ def st_upload(options, args, print_queue, error_queue):
     # permissions, so we'll ignore any error. If there's really a problem,
     # it'll surface on the first object PUT.
     try:
-        conn.put_container(args[0])
+        for container in shard_containers(args[0],
+                                          options.container_shards):
+            conn.put_container(container)
         if options.segment_size is not None:
             conn.put_container(args[0] + '_segments')
     except Exception:
         pass
     try:
+        if options.dedup:
+            if options.dedup_index:
+                try:
+                    fp = open(options.dedup_index)
+                    for line in fp:
+                        etag, container, obj = line.split()
+                        if etag != 'd41d8cd98f00b204e9800998ecf8427e':
+                            _dedup_known(etag, unquote(container),
+                                         unquote(obj))
+                        if len(dedup_saved) < options.dedup_max:
+                            dedup_saved.add(etag)
+                    fp.close()
+                except IOError, err:
+                    if err.errno != ENOENT:
+                        raise
+            dedup_thread = Thread(target=_dedup_load)
+            dedup_thread.daemon = True
+            dedup_thread.start()
         for arg in args[1:]:
             if isdir(arg):
                 _upload_dir(arg)
             else:
-                object_queue.put({'path': arg})
+                _queue_file(arg)
+        _flush_archive()
         while not object_queue.empty():
             sleep(0.01)
         for thread in object_threads:
@@ -1634,6 +4505,262 @@ def st_upload(options, args, print_queue, error_queue):
         if err.http_status != 404:
             raise
         error_queue.put('Account not found')
+    finally:
+        if journal:
+            journal.close()
+
+
+st_dist_help = '''
+dist [options] <dir> upload container file_or_directory [...]
+dist [options] <dir> download|delete container
+    Shares an upload, download or delete between any number of st processes
+    on any number of hosts that see the same directory <dir>. The first to
+    start splits the job into shards of --shard-size objects. Each process
+    then claims shards through lease files in <dir> and renews its leases
+    while it works. A shard whose lease goes --lease-time seconds without
+    renewal is taken over by another process, which resumes it from the
+    shard's journal. Options for the command itself go in --command-options.
+    Files to upload must have the same paths on every host.
+'''.strip('\n')
+
+
+def st_dist(parser, args, print_queue, error_queue):
+    parser.add_option('', '--shard-size', type='int', dest='shard_size',
+        default=1000, help='Number of objects in each shard')
+    parser.add_option('', '--lease-time', type='int', dest='lease_time',
+        default=60, help='Seconds a shard lease lasts without renewal')
+    parser.add_option('', '--max-attempts', type='int', dest='max_attempts',
+        default=3, help='Times a shard is tried before it is given up')
+    parser.add_option('', '--command-options', dest='command_options',
+        default='', help='Options to run the command with, as one string')
+    # Global options come before "dist" and are passed on to the processes
+    # running the shards; the rest are for dist itself.
+    parser.disable_interspersed_args()
+    (options, rest) = parse_args(parser, args)
+    global_args = args[:len(args) - len(rest)]
+    (options, rest) = parser.parse_args(rest[1:], values=options)
+    parser.enable_interspersed_args()
+    if len(rest) < 3 or rest[1] not in ('upload', 'download', 'delete') or \
+            (rest[1] == 'upload') != (len(rest) > 3):
+        error_queue.put('Usage: %s [options] %s' %
+                        (basename(argv[0]), st_dist_help))
+        return
+    workdir, command, container = rest[:3]
+    paths = rest[3:]
+    worker = '%s:%d' % (socket.gethostname(), getpid())
+    for name in ('shards', 'leases', 'journals'):
+        mkdirs(join(workdir, name))
+    plan_path = join(workdir, 'plan')
+
+    def _plan_lock(generation):
+        return join(workdir, 'plan.lock.%d' % generation)
+
+    def _items():
+        if command == 'upload':
+            stack = list(reversed(paths))
+            while stack:
+                path = stack.pop()
+                if isdir(path):
+                    stack.extend(join(path, name)
+                                 for name in reversed(listdir(path)))
+                else:
+                    yield path
+            return
+        url, token = get_credentials(options.auth, options.user,
+            options.key, snet=options.snet).get()
+        create_connection = lambda: Connection(options.auth, options.user,
+            options.key, preauthurl=url, preauthtoken=token,
+            snet=options.snet)
+        for objects in container_listing(create_connection(), container,
+                shards=options.listing_shards,
+                create_connection=create_connection,
+                container_shards=options.container_shards):
+            for obj in objects:
+                yield obj['name'].encode('utf8')
+
+    def _write(path, data):
+        tmp = '%s.%s.tmp' % (path, worker)
+        fp = open(tmp, 'w')
+        fp.write(data)
+        fp.close()
+        rename(tmp, path)
+
+    def _plan(generation):
+        count = 0
+        items = []
+        for item in _items():
+            items.append(quote(item, safe=''))
+            if len(items) >= options.shard_size:
+                _write(join(workdir, 'shards', '%06d' % count),
+                       '\n'.join(items) + '\n')
+                count += 1
+                items = []
+                if exists(_plan_lock(generation + 1)):
+                    # Taken over after a stall; let the new planner finish.
+                    return
+                # Keep the plan lock fresh so no one takes over the plan.
+                utime(_plan_lock(generation), None)
+        if items:
+            _write(join(workdir, 'shards', '%06d' % count),
+                   '\n'.join(items) + '\n')
+            count += 1
+        _write(plan_path, '%d\n' % count)
+
+    # Like the shard leases, a stale plan lock is taken over by creating
+    # the next generation's lock, which only one process can do.
+    generation = 0
+    while not exists(plan_path):
+        try:
+            close(os_open(_plan_lock(generation),
+                          O_CREAT | O_EXCL | O_WRONLY, 0644))
+        except OSError, err:
+            if err.errno != EEXIST:
+                raise
+            try:
+                if time() - getmtime(_plan_lock(generation)) > \
+                        options.lease_time:
+                    generation += 1
+                    continue
+            except OSError:
+                pass
+            sleep(1)
+            continue
+        _plan(generation)
+    shard_count = int(open(plan_path).read())
+
+    def _lease(shard, generation):
+        return join(workdir, 'leases', '%06d.%s' % (shard, generation))
+
+    def _finished(shard):
+        return exists(_lease(shard, 'done')) or \
+            exists(_lease(shard, 'failed'))
+
+    def _mark(shard, state):
+        _write(_lease(shard, state), worker + '\n')
+
+    def _claim(shard):
+        """ Returns the lease generation claimed, or None. Each takeover
+            creates the next generation's file exclusively, so only one
+            process can win it. """
+        generation = 0
+        while exists(_lease(shard, generation)):
+            generation += 1
+        if generation:
+            try:
+                age = time() - getmtime(_lease(shard, generation - 1))
+            except OSError:
+                return None
+            if age < options.lease_time:
+                return None
+            if generation >= options.max_attempts:
+                error_queue.put('Shard %d failed %d times; giving up' %
+                                (shard, generation))
+                _mark(shard, 'failed')
+                return None
+        try:
+            fd = os_open(_lease(shard, generation),
+                         O_CREAT | O_EXCL | O_WRONLY, 0644)
+        except OSError, err:
+            if err.errno != EEXIST:
+                raise
+            return None
+        fp = fdopen(fd, 'w')
+        fp.write(worker + '\n')
+        fp.close()
+        return generation
+
+    def _run(shard, generation):
+        # The names go in a file, as a shard of them may not fit in argv.
+        proc = Popen([executable, argv[0]] + global_args +
+            ['--journal', join(workdir, 'journals', '%06d' % shard),
+             '--resume', '--error-status', '--objects-from',
+             join(workdir, 'shards', '%06d' % shard), command] +
+            shlex_split(options.command_options) + ['--', container])
+        renewed = time()
+        while proc.poll() is None:
+            sleep(0.1)
+            if time() - renewed >= options.lease_time / 3.0:
+                if exists(_lease(shard, generation + 1)):
+                    # Taken over after a stall; let the new owner finish.
+                    proc.kill()
+                    proc.wait()
+                    return
+                utime(_lease(shard, generation), None)
+                renewed = time()
+        if proc.returncode == 0:
+            _mark(shard, 'done')
+        else:
+            error_queue.put('Shard %d exited with status %d' %
+                            (shard, proc.returncode))
+
+    while True:
+        unfinished = [shard for shard in xrange(shard_count)
+                      if not _finished(shard)]
+        if not unfinished:
+            break
+        claimed = False
+        for shard in unfinished:
+            if _finished(shard):
+                continue
+            generation = _claim(shard)
+            if generation is not None:
+                claimed = True
+                _run(shard, generation)
+        if not claimed:
+            sleep(min(options.lease_time / 3.0, 5))
+    objects = total_bytes = failed = 0
+    for shard in xrange(shard_count):
+        if exists(_lease(shard, 'failed')):
+            failed += 1
+        try:
+            fp = open(join(workdir, 'journals', '%06d' % shard))
+        except IOError, err:
+            if err.errno != ENOENT:
+                raise
+            continue
+        for line in fp:
+            parts = line.split()
+            if len(parts) == 6 and parts[2].isdigit():
+                objects += 1
+                total_bytes += int(parts[2])
+        fp.close()
+    report(print_queue, options,
+           '%s: %d objects, %d bytes in %d shards (%d failed)' %
+           (command, objects, total_bytes, shard_count, failed),
+           command=command, objects=objects, bytes=total_bytes,
+           shards=shard_count, failed=failed)
+
+
+def open_journal(options):
+    """Returns the Journal asked for with --journal and --resume, if any."""
+    if options.resume and not options.journal:
+        exit('--resume option requires --journal')
+    if options.journal:
+        return Journal(options.journal, resume=options.resume)
+    return None
+
+
+def objects_from(options, args):
+    """ Returns args with the names in the --objects-from file, one
+        URL-quoted name per line, added after the container. Returns None
+        if the file lists no names, as a lone container would mean all of
+        it. """
+    if not options.objects_from:
+        return args
+    if not args:
+        exit('--objects-from option requires a container')
+    try:
+        fp = open(options.objects_from)
+        try:
+            names = [unquote(line.rstrip('\n')) for line in fp
+                     if line.rstrip('\n')]
+        finally:
+            fp.close()
+    except IOError, err:
+        exit('Could not read --objects-from file: %s' % err)
+    if not names:
+        return None
+    return args + names
 
 
 def parse_args(parser, args, enforce_requires=True):
@@ -1654,11 +4781,17 @@ Usage: %%prog <command> [options] [args]
 
 Commands:
   %(st_stat_help)s
+  %(st_du_help)s
   %(st_list_help)s
   %(st_upload_help)s
   %(st_post_help)s
+  %(st_tempurl_help)s
+  %(st_formpost_help)s
   %(st_download_help)s
   %(st_delete_help)s
+  %(st_copy_help)s
+  %(st_move_help)s
+  %(st_dist_help)s
 
 Example:
   %%prog -A https://auth.api.rackspacecloud.com/v1.0 -U user -K key stat
@@ -1678,41 +4811,111 @@ Example:
     parser.add_option('-K', '--key', dest='key',
                       default=environ.get('ST_KEY'),
                       help='Key for obtaining an auth token')
+    parser.add_option('', '--listing-shards', type='int',
+                      dest='listing_shards', default=1,
+                      help='Number of concurrent requests to split container '
+                      'listings across (list, du, download, delete, copy '
+                      'and move)')
+    parser.add_option('', '--container-shards', type='int',
+                      dest='container_shards', default=1,
+                      help='Spread the objects of a container over this many '
+                      'containers named <container>_<n>, picked by a hash of '
+                      'the object name (upload, list, download and delete)')
+    parser.add_option('', '--endpoints', dest='endpoints',
+                      default=environ.get('ST_ENDPOINTS'),
+                      help='Comma separated host[:port] or scheme://host'
+                      '[:port] storage endpoints to spread requests across '
+                      'instead of the host in the storage URL')
+    parser.add_option('', '--journal', dest='journal',
+                      help='Append each completed object to this file '
+                      '(upload, download and delete)')
+    parser.add_option('', '--resume', action='store_true', dest='resume',
+                      default=False, help='Skip the objects recorded in '
+                      'the --journal file by an earlier run')
+    parser.add_option('', '--objects-from', dest='objects_from',
+                      help='Also act on the URL-quoted names in this file, '
+                      'one per line, after the container (upload, download '
+                      'and delete)')
+    parser.add_option('', '--error-status', action='store_true',
+                      dest='error_status', default=False,
+                      help='Exit with status 1 if any error was reported, '
+                      'such as an object that failed (dist runs shards '
+                      'this way)')
+    parser.add_option('', '--expect-continue', action='store_true',
+                      dest='expect_continue', default=False,
+                      help='Send object bodies only once the server answers '
+                      'Expect: 100-continue, so refused uploads cost no '
+                      'transfer')
+    parser.add_option('', '--small-size', type='int', dest='small_size',
+                      default=0, help='Schedule objects smaller than this '
+                      'many bytes separately from larger ones (upload and '
+                      'download; 0 disables)')
+    parser.add_option('', '--small-slots', type='int', dest='small_slots',
+                      default=2, help='Number of the 10 transfer threads '
+                      'reserved for small objects when --small-size is set')
+    parser.add_option('', '--large-slots', type='int', dest='large_slots',
+                      default=2, help='Number of the 10 transfer threads '
+                      'reserved for large objects when --small-size is set')
+    parser.add_option('', '--shortest-first', action='store_true',
+                      dest='shortest_first', default=False,
+                      help='Transfer the smallest queued objects first '
+                      '(upload and download)')
+    parser.add_option('', '--format', type='choice', dest='format',
+                      choices=('text', 'json'), default='text',
+                      help='Print text (default) or one JSON object per '
+                      'line with the name, bytes, ETag, status and seconds '
+                      'taken (list, upload, download, delete and stat)')
     parser.disable_interspersed_args()
     (options, args) = parse_args(parser, argv[1:], enforce_requires=False)
     parser.enable_interspersed_args()
-
-    commands = ('delete', 'download', 'list', 'post', 'stat', 'upload')
+    endpoints = [e.strip() for e in (options.endpoints or '').split(',')
+                 if e.strip()]
+    if endpoints:
+        Connection.endpoints = EndpointPool(endpoints)
+    Connection.expect_continue = options.expect_continue
+
+    commands = ('copy', 'delete', 'dist', 'download', 'du', 'formpost',
+                'list', 'move', 'post', 'stat', 'tempurl', 'upload')
     if not args or args[0] not in commands:
         parser.print_usage()
         if args:
             exit('no such command: %s' % args[0])
         exit()
 
-    print_queue = Queue(10000)
-
-    def _print(item):
-        if isinstance(item, unicode):
-            item = item.encode('utf8')
-        print item
+    parser.usage = globals()['st_%s_help' % args[0]]
+    command_args = {}
+    if args[0] == 'upload':
+        upload_options(parser)
+        # Forked before any thread starts, as a process forked later would
+        # inherit whatever locks those threads held at the time.
+        (upload, _junk) = parse_args(parser, argv[1:])
+        if upload.derivatives and Image is not None:
+            command_args['derivative_pool'] = \
+                Pool(upload.derivative_processes or cpu_count())
 
-    print_thread = QueueFunctionThread(print_queue, _print)
+    print_queue = Queue(10000)
+    print_thread = BatchedPrintThread(print_queue, stdout)
     print_thread.start()
 
     error_queue = Queue(10000)
+    error_count = [0]
 
     def _error(item):
+        error_count[0] += 1
         if isinstance(item, unicode):
             item = item.encode('utf8')
         print >> stderr, item
 
     error_thread = QueueFunctionThread(error_queue, _error)
     error_thread.start()
+    QueueFunctionThread.error_queue = error_queue
 
     try:
-        parser.usage = globals()['st_%s_help' % args[0]]
         globals()['st_%s' % args[0]](parser, argv[1:], print_queue,
-                                     error_queue)
+                                     error_queue, **command_args)
+        if command_args.get('derivative_pool'):
+            command_args['derivative_pool'].close()
+            command_args['derivative_pool'].join()
         while not print_queue.empty():
             sleep(0.01)
         print_thread.abort = True
@@ -1723,7 +4926,9 @@ Example:
         error_thread.abort = True
         while error_thread.isAlive():
             error_thread.join(0.01)
-    except Exception:
+    except (Exception, SystemExit):
         for thread in threading_enumerate():
             thread.abort = True
         raise
+    if options.error_status and error_count[0]:
+        exit(1)